@@ -0,0 +1,63 @@
+"""Stands in for gocode, golint and the other Go tools during benchmarks.
+
+The runner installs a wrapper per tool name that execs this script with the
+tool name as the first argument. Behaviour is controlled by environment
+variables:
+
+  GOTOOLS_FAKE_LATENCY_MS  milliseconds to sleep before answering (default 0)
+  GOTOOLS_FAKE_CANDIDATES  completion candidates gocode returns (default 200)
+  GOTOOLS_FAKE_LINES       lines of diagnostics linters print (default 100)
+  GOTOOLS_FAKE_FILE        file name linters report against (default main.go)
+"""
+
+import json
+import os
+import sys
+import time
+
+
+def candidates(count):
+    classes = ('func', 'var', 'type', 'func', 'const')
+    result = []
+    for i in range(count):
+        cls = classes[i % len(classes)]
+        if cls == 'func':
+            typ = 'func(ctx context.Context, name string, opts ...Option{0}) (*Result, error)'.format(i)
+        elif cls == 'type':
+            typ = 'struct'
+        else:
+            typ = 'int'
+        result.append({'class': cls, 'name': 'Name{0}'.format(i), 'type': typ})
+    return result
+
+
+def main():
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    if not sys.stdin.isatty():
+        sys.stdin.buffer.read()
+
+    latency = float(os.environ.get('GOTOOLS_FAKE_LATENCY_MS', '0'))
+    if latency:
+        time.sleep(latency / 1000.0)
+
+    lines = int(os.environ.get('GOTOOLS_FAKE_LINES', '100'))
+    file_name = os.environ.get('GOTOOLS_FAKE_FILE', 'main.go')
+
+    if tool == 'gocode':
+        count = int(os.environ.get('GOTOOLS_FAKE_CANDIDATES', '200'))
+        sys.stdout.write(json.dumps([0, candidates(count)]))
+    elif tool == 'golint':
+        for i in range(lines):
+            sys.stdout.write('{0}:{1}:{2}: exported function Name{1} should have comment\n'.format(file_name, i + 1, 1))
+    elif tool == 'go' and args[:1] == ['vet']:
+        for i in range(lines):
+            sys.stderr.write('{0}:{1}:{2}: unreachable code\n'.format(file_name, i + 1, 1))
+        return 1
+    elif tool == 'godef':
+        sys.stdout.write('{0}:1:1\n'.format(os.path.abspath(file_name)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,339 @@
+"""Headless benchmarks for the plugin's hot paths.
+
+Runs outside Sublime Text, against the stub modules in benchmarks/stubs and
+fake tool executables (see fake_tool.py), and prints machine-readable JSON
+so runs before and after a change can be compared:
+
+    python3 benchmarks/run.py --output before.json
+    ... change something ...
+    python3 benchmarks/run.py --compare before.json
+
+Every benchmark reports per-iteration wall time in milliseconds.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import types
+
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+TOOLS = ('gocode', 'golint', 'go', 'godef', 'gofmt')
+
+
+def load_plugin():
+    """Import the plugin as the `GoTools` package, as Sublime does."""
+    sys.path.insert(0, os.path.join(HERE, 'stubs'))
+    package = types.ModuleType('GoTools')
+    package.__path__ = [ROOT]
+    sys.modules['GoTools'] = package
+
+    import importlib
+    modules = {}
+    for name in ('gotools_util', 'gotools_suggestions', 'gotools_lint', 'gotools_format'):
+        modules[name] = importlib.import_module('GoTools.' + name)
+    return modules
+
+
+def install_fake_tools(bin_dir):
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'.format(
+                sys.executable, os.path.join(HERE, 'fake_tool.py'), tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+
+def go_source(lines, seed=1):
+    """A Go file of roughly the given number of lines, with some non-ASCII text."""
+    rng = random.Random(seed)
+    out = ['package main', '', 'import "fmt"', '']
+    i = 0
+    while len(out) < lines:
+        out.append('// Name{0} does things — naïvely, {1}.'.format(i, 'ü' * rng.randint(0, 8)))
+        out.append('func Name{0}(a int, b string) (int, error) {{'.format(i))
+        out.append('\tfmt.Println("héllo", a, b)')
+        out.append('\treturn a + {0}, nil'.format(rng.randint(0, 1000)))
+        out.append('}')
+        out.append('')
+        i += 1
+    return '\n'.join(out[:lines]) + '\n'
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return OrderedDict([
+        ('iterations', n),
+        ('mean_ms', round(sum(samples) / n, 4)),
+        ('p50_ms', round(samples[n // 2], 4)),
+        ('p95_ms', round(samples[min(n - 1, int(n * 0.95))], 4)),
+        ('min_ms', round(samples[0], 4)),
+        ('max_ms', round(samples[-1], 4)),
+    ])
+
+
+def measure(fn, iterations, setup=None):
+    samples = []
+    for _ in range(iterations):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        fn(state)
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def bench_offsets(m, opts):
+    """Byte offsets of rows in a large file: cold (just edited), warm, and warm after an edit."""
+    import sublime
+    Buffers = m['gotools_util'].Buffers
+    lines = opts.lines
+    view = sublime.View(go_source(lines), file_name='/tmp/offsets.go')
+    rng = random.Random(2)
+    rows = [rng.randrange(lines) for _ in range(opts.iterations)]
+
+    def cold_setup():
+        view.insert(None, 0, ' ')
+        view.erase(None, sublime.Region(0, 1))
+
+    results = OrderedDict()
+    results['offsets.cold_last_row'] = measure(lambda _: Buffers.offset_at_row_col(view, lines - 1, 3),
+                                               max(5, opts.iterations // 20), cold_setup)
+    Buffers.offset_at_row_col(view, lines - 1, 0)
+    it = iter(rows)
+    results['offsets.warm_random_row'] = measure(lambda _: Buffers.offset_at_row_col(view, next(it), 3),
+                                                 opts.iterations)
+
+    # Typing near the end of the file and asking for the offset at the cursor
+    # after every keystroke, as completion does, with the edit tracker
+    # keeping the table above the edit.
+    tracker = m['gotools_util'].GotoolsOffsetTracker()
+    tracker.attach(view.buffer())
+    cursor = [view.text_point(lines - 2, 0)]
+
+    def type_setup():
+        view.insert(None, cursor[0], 'x')
+        cursor[0] += 1
+
+    Buffers.offset_at_point(view, cursor[0])
+    results['offsets.warm_after_edit'] = measure(lambda _: Buffers.offset_at_point(view, cursor[0]),
+                                                 opts.iterations, type_setup)
+    tracker.detach()
+    return results
+
+
+def bench_suggestions(m, opts):
+    """Turning gocode candidates into completions."""
+    suggestions = m['gotools_suggestions']
+    sys.path.insert(0, HERE)
+    import fake_tool
+    candidates = fake_tool.candidates(opts.candidates)
+    funcs = [c['type'] for c in candidates if c['class'] == 'func']
+
+    results = OrderedDict()
+    results['suggestions.lex_func_type'] = measure(
+        lambda _: [suggestions._lex_func_type(t) for t in funcs], opts.repeat)
+    results['suggestions.build_all'] = measure(
+        lambda _: [suggestions.GotoolsSuggestions.build_suggestion(c) for c in candidates], opts.repeat)
+    results['suggestions.rank_and_build'] = measure(
+        lambda _: suggestions.GotoolsSuggestions.build_suggestions(
+            suggestions.rank_candidates(candidates, 'nme1', 100)), opts.repeat)
+    for entry in results.values():
+        entry['candidates'] = len(candidates)
+    return results
+
+
+def bench_lint_parse(m, opts):
+    """Parsing a large linter report for one file and updating its diagnostics."""
+    import sublime
+    lint = m['gotools_lint']
+    view = sublime.View(go_source(opts.lines), file_name='/tmp/lint/main.go')
+    listener = lint.GotoolsLint(view)
+    sublime._timers[:] = []
+    report = ''.join('/tmp/lint/main.go:{0}:{1}: exported function Name{0} should have comment\n'.format(i + 1, 2)
+                     for i in range(opts.diagnostics))
+    output = (report, '', 0)
+
+    results = OrderedDict()
+    results['lint.parse_diagnostics'] = measure(
+        lambda _: listener.parse_diagnostics(report, lint.LINTERS[1][2]), opts.repeat)
+    listener.apply(1, output)
+    results['lint.apply_unchanged'] = measure(lambda _: listener.apply(1, output), opts.repeat)
+    results['lint.token_digest'] = measure(
+        lambda _: lint.token_digest(view.substr(sublime.Region(0, view.size()))), opts.repeat)
+    for name in ('lint.parse_diagnostics', 'lint.apply_unchanged'):
+        results[name]['diagnostics'] = opts.diagnostics
+    listener.on_close()
+    return results
+
+
+def bench_format_diff(m, opts):
+    """Diffing formatter output against a large buffer with scattered changes."""
+    diff_hunks = m['gotools_format'].diff_hunks
+    old = go_source(opts.lines)
+    lines = old.splitlines(True)
+    rng = random.Random(3)
+    for row in rng.sample(range(len(lines)), 50):
+        lines[row] = lines[row].replace('\t', '    ')
+    new = ''.join(lines)
+    return OrderedDict([('format.diff_hunks', measure(lambda _: diff_hunks(old, new), opts.repeat))])
+
+
+def bench_tool_spawn(m, opts):
+    """Running a tool that answers immediately through ToolRunner: directly, via the spawner and from the disk cache."""
+    import golangconfig
+    import sublime
+    util = m['gotools_util']
+    view = sublime.View('', file_name='/tmp/spawn/main.go')
+    spawn = lambda _: util.ToolRunner.run(view, 'godef', ['-f', 'main.go', '-o', '0'], feature='goto_def')
+
+    results = OrderedDict()
+    os.environ['GOTOOLS_FAKE_LATENCY_MS'] = '0'
+    try:
+        results['tools.spawn'] = measure(spawn, opts.spawns)
+        golangconfig.SETTINGS['spawner_python'] = sys.executable
+        spawn(None)
+        results['tools.spawn_via_spawner'] = measure(spawn, opts.spawns)
+        golangconfig.SETTINGS['spawner_python'] = ''
+        golangconfig.SETTINGS['disk_cache_mb'] = 16
+        cache_key = str(time.time())
+        cached = lambda _: util.ToolRunner.run(view, 'godef', ['-f', 'main.go', '-o', '0'], feature='goto_def',
+                                               cache_key=cache_key)
+        cached(None)
+        results['tools.disk_cache_hit'] = measure(cached, opts.spawns)
+    finally:
+        golangconfig.SETTINGS['spawner_python'] = ''
+        golangconfig.SETTINGS['disk_cache_mb'] = 0
+        util.Spawner.shutdown()
+        os.environ['GOTOOLS_FAKE_LATENCY_MS'] = str(opts.latency_ms)
+    return results
+
+
+def bench_keystroke(m, opts):
+    """Completion requests while typing an identifier, end to end.
+
+    The first keystroke of a word queries gocode (with the configured fake
+    latency); later ones should be answered without spawning anything.
+    """
+    import sublime
+    suggestions = m['gotools_suggestions']
+    source = go_source(opts.lines)
+    anchor = source.index('\treturn', len(source) // 2)
+    word = 'Name12345'
+
+    listener = suggestions.GotoolsSuggestions()
+    misses = []
+    hits = []
+    for _ in range(opts.words):
+        view = sublime.View(source, file_name='/tmp/keystroke/main.go')
+        point = anchor
+        for n, char in enumerate(word):
+            view.insert(None, point, char)
+            point += 1
+            start = time.perf_counter()
+            listener.on_query_completions(view, word[:n + 1], [point])
+            (misses if n == 0 else hits).append((time.perf_counter() - start) * 1000)
+        # Leave the word so the next one starts cold.
+        listener.cache.entries.clear()
+
+    results = OrderedDict()
+    results['keystroke.first'] = summarize(misses)
+    results['keystroke.subsequent'] = summarize(hits)
+    for entry in results.values():
+        entry['tool_latency_ms'] = opts.latency_ms
+        entry['lines'] = opts.lines
+    return results
+
+
+BENCHMARKS = OrderedDict([
+    ('offsets', bench_offsets),
+    ('suggestions', bench_suggestions),
+    ('lint_parse', bench_lint_parse),
+    ('format_diff', bench_format_diff),
+    ('tool_spawn', bench_tool_spawn),
+    ('keystroke', bench_keystroke),
+])
+
+
+def compare(baseline, results):
+    out = []
+    for name, entry in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            out.append('{0: <32} {1: >10.3f} ms  (new)'.format(name, entry['p50_ms']))
+            continue
+        ratio = entry['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('inf')
+        out.append('{0: <32} {1: >10.3f} ms  was {2: >10.3f} ms  x{3:.2f}'.format(
+            name, entry['p50_ms'], before['p50_ms'], ratio))
+    return '\n'.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help='smaller inputs and fewer iterations')
+    parser.add_argument('--lines', type=int, default=50000, help='lines in generated Go files')
+    parser.add_argument('--candidates', type=int, default=5000, help='completion candidates')
+    parser.add_argument('--diagnostics', type=int, default=10000, help='linter diagnostics to parse')
+    parser.add_argument('--latency-ms', type=float, default=20, help='latency of the fake tools')
+    parser.add_argument('--iterations', type=int, default=2000, help='iterations of cheap operations')
+    parser.add_argument('--repeat', type=int, default=20, help='iterations of expensive operations')
+    parser.add_argument('--spawns', type=int, default=50, help='tool processes to spawn')
+    parser.add_argument('--words', type=int, default=10, help='identifiers to type')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='print the change against an earlier JSON result')
+    opts = parser.parse_args()
+    if opts.quick:
+        opts.lines, opts.candidates, opts.diagnostics = 5000, 500, 1000
+        opts.iterations, opts.repeat, opts.spawns, opts.words = 200, 3, 10, 3
+
+    unknown = [b for b in opts.benchmarks if b not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark: ' + ', '.join(unknown))
+
+    bin_dir = tempfile.mkdtemp(prefix='gotools-bench-')
+    try:
+        install_fake_tools(bin_dir)
+        os.environ['GOTOOLS_FAKE_LATENCY_MS'] = str(opts.latency_ms)
+        os.environ['GOTOOLS_FAKE_CANDIDATES'] = str(opts.candidates)
+        modules = load_plugin()
+
+        results = OrderedDict()
+        for name, bench in BENCHMARKS.items():
+            if opts.benchmarks and name not in opts.benchmarks:
+                continue
+            results.update(bench(modules, opts))
+    finally:
+        shutil.rmtree(bin_dir, ignore_errors=True)
+
+    report = OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('options', OrderedDict((k, v) for k, v in sorted(vars(opts).items())
+                                if k not in ('output', 'compare'))),
+        ('results', results),
+    ])
+    text = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
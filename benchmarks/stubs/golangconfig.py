@@ -0,0 +1,32 @@
+"""A minimal stand-in for the golangconfig dependency.
+
+Tools are looked up on PATH, where the benchmark runner puts its fake tool
+executables first. Settings come from the SETTINGS dict.
+"""
+
+import os
+import shutil
+
+SETTINGS = {
+    'gocode_session': False,
+    'symbol_index': False,
+    'prefetch_idle_ms': 0,
+    'completion_limit': 100,
+    'spawner_python': '',
+    'disk_cache_mb': 0,
+}
+
+
+class ExecutableError(EnvironmentError):
+    pass
+
+
+def subprocess_info(executable_name, required_vars, optional_vars=None, view=None, window=None):
+    path = shutil.which(executable_name)
+    if path is None:
+        raise ExecutableError("unable to find " + executable_name)
+    return path, dict(os.environ)
+
+
+def setting_value(setting_name, view=None, window=None):
+    return SETTINGS.get(setting_name), 'benchmark'
@@ -0,0 +1,309 @@
+"""A minimal stand-in for Sublime Text's `sublime` module.
+
+Only what GoTools touches is implemented. Views keep a table of line starts
+so that text_point/rowcol are cheap, as they are in Sublime itself, and
+don't distort the measurements. Timers are queued rather than run; call
+run_timers() to flush them.
+"""
+
+import bisect
+import re
+import tempfile
+
+INHIBIT_WORD_COMPLETIONS = 8
+INHIBIT_EXPLICIT_COMPLETIONS = 16
+LAYOUT_INLINE = 0
+LAYOUT_BELOW = 1
+LAYOUT_BLOCK = 2
+ENCODED_POSITION = 1
+HIDDEN = 128
+
+_timers = []
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def contains(self, x):
+        if isinstance(x, Region):
+            return self.begin() <= x.begin() and x.end() <= self.end()
+        return self.begin() <= x <= self.end()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __hash__(self):
+        return hash((self.a, self.b))
+
+    def __repr__(self):
+        return "Region({0}, {1})".format(self.a, self.b)
+
+
+class Settings(dict):
+    def set(self, key, value):
+        self[key] = value
+
+    def add_on_change(self, tag, callback):
+        pass
+
+    def clear_on_change(self, tag):
+        pass
+
+
+class Selection(list):
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+class Phantom(object):
+    def __init__(self, region, content, layout, on_navigate=None):
+        self.region = region
+        self.content = content
+        self.layout = layout
+
+
+class PhantomSet(object):
+    def __init__(self, view, key=""):
+        self.view = view
+        self.phantoms = []
+
+    def update(self, phantoms):
+        self.phantoms = list(phantoms)
+
+
+WORD_RE = re.compile(r'\w')
+_next_id = [0]
+
+
+class HistoricPosition(object):
+    def __init__(self, view, pt):
+        self.pt = pt
+        self.row, self.col = view.rowcol(pt)
+        line = view._text[view._line_starts[self.row]:pt]
+        self.col_utf16 = len(line.encode('utf-16-le')) // 2
+        self.col_utf8 = len(line.encode('utf-8'))
+
+
+class TextChange(object):
+    def __init__(self, a, b, text):
+        self.a = a
+        self.b = b
+        self.str = text
+        self.len_utf16 = len(text.encode('utf-16-le')) // 2
+        self.len_utf8 = len(text.encode('utf-8'))
+
+
+class Buffer(object):
+    def __init__(self, view):
+        self._view = view
+        self._listeners = []
+
+    def primary_view(self):
+        return self._view
+
+
+class View(object):
+    def __init__(self, text="", file_name=None, syntax='Packages/GoTools/GoTools.tmLanguage'):
+        _next_id[0] += 1
+        self._id = _next_id[0]
+        self._file_name = file_name
+        self._change_count = 0
+        self._saved_change_count = 0
+        self._sel = Selection([Region(0)])
+        self._settings = Settings(syntax=syntax)
+        self._regions = {}
+        self._status = {}
+        self._buffer = Buffer(self)
+        self._set_text(text)
+
+    def _set_text(self, text):
+        self._text = text
+        starts = [0]
+        pos = text.find('\n')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+        self._line_starts = starts
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._id
+
+    def buffer(self):
+        return self._buffer
+
+    def file_name(self):
+        return self._file_name
+
+    def window(self):
+        return None
+
+    def settings(self):
+        return self._settings
+
+    def size(self):
+        return len(self._text)
+
+    def change_count(self):
+        return self._change_count
+
+    def is_loading(self):
+        return False
+
+    def is_dirty(self):
+        return self._change_count != self._saved_change_count
+
+    def _mark_saved(self):
+        """Stand in for saving: the buffer now matches the file on disk."""
+        self._saved_change_count = self._change_count
+
+    def is_valid(self):
+        return True
+
+    def sel(self):
+        return self._sel
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self._text[x.begin():x.end()]
+        return self._text[x:x + 1]
+
+    def text_point(self, row, col):
+        row = max(0, min(row, len(self._line_starts) - 1))
+        return min(self._line_starts[row] + col, len(self._text))
+
+    def rowcol(self, point):
+        row = bisect.bisect_right(self._line_starts, point) - 1
+        return row, point - self._line_starts[row]
+
+    def line(self, x):
+        point = x.begin() if isinstance(x, Region) else x
+        row = self.rowcol(point)[0]
+        start = self._line_starts[row]
+        end = self._line_starts[row + 1] - 1 if row + 1 < len(self._line_starts) else len(self._text)
+        return Region(start, end)
+
+    def full_line(self, x):
+        line = self.line(x)
+        return Region(line.a, min(line.b + 1, len(self._text)))
+
+    def word(self, x):
+        point = x.begin() if isinstance(x, Region) else x
+        start = point
+        while start > 0 and WORD_RE.match(self._text[start - 1]):
+            start -= 1
+        end = point
+        while end < len(self._text) and WORD_RE.match(self._text[end]):
+            end += 1
+        return Region(start, end)
+
+    def visible_region(self):
+        return Region(0, len(self._text))
+
+    def score_selector(self, point, selector):
+        return 1 if 'source.go' in selector else 0
+
+    def match_selector(self, point, selector):
+        return False
+
+    def find_by_selector(self, selector):
+        return []
+
+    def add_regions(self, key, regions, *args, **kwargs):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def set_status(self, key, value):
+        self._status[key] = value
+
+    def erase_status(self, key):
+        self._status.pop(key, None)
+
+    def run_command(self, name, args=None):
+        pass
+
+    # Editing; in Sublime these need an Edit from a TextCommand.
+    def replace(self, edit, region, text):
+        begin, end = region.begin(), region.end()
+        change = TextChange(HistoricPosition(self, begin), HistoricPosition(self, end), text)
+        self._set_text(self._text[:begin] + text + self._text[end:])
+        self._change_count += 1
+        # Regions move with the text like Sublime's do.
+        def shift(p):
+            if p <= begin:
+                return p
+            if p >= end:
+                return p + len(text) - (end - begin)
+            return begin
+        for key, regions in self._regions.items():
+            self._regions[key] = [Region(shift(r.a), shift(r.b)) for r in regions]
+        for listener in list(self._buffer._listeners):
+            listener.on_text_changed([change])
+
+    def insert(self, edit, point, text):
+        self.replace(edit, Region(point), text)
+        return len(text)
+
+    def erase(self, edit, region):
+        self.replace(edit, region, '')
+
+
+def set_timeout(callback, delay=0):
+    _timers.append(callback)
+
+
+def set_timeout_async(callback, delay=0):
+    _timers.append(callback)
+
+
+def run_timers():
+    while _timers:
+        _timers.pop(0)()
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    pass
+
+
+def load_settings(name):
+    return Settings()
+
+
+def cache_path():
+    return tempfile.gettempdir()
+
+
+def active_window():
+    return None
+
+
+def windows():
+    return []
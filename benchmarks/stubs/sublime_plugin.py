@@ -0,0 +1,39 @@
+"""A minimal stand-in for Sublime Text's `sublime_plugin` module."""
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class TextChangeListener(object):
+    """Attached to a View's buffer by hand; View edits call on_text_changed."""
+
+    def __init__(self):
+        self.buffer = None
+
+    def attach(self, buffer):
+        self.buffer = buffer
+        buffer._listeners.append(self)
+
+    def detach(self):
+        self.buffer._listeners.remove(self)
+        self.buffer = None
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand(object):
+    pass
@@ -1,5 +1,7 @@
 import sublime
 import sublime_plugin
+import difflib
+import hashlib
 import os
 import golangconfig
 import re
@@ -9,14 +11,62 @@ from .gotools_util import GoBuffers
 from .gotools_util import Logger
 from .gotools_util import ToolRunner
 
+def diff_hunks(old, new):
+    """Return the line hunks turning old into new as (start, end, replacement) tuples.
+
+    start and end are character offsets into old, and hunks are ordered from
+    the end of the text backwards so they can be applied one after another.
+    Lines shared at the start and end are trimmed before diffing, so a
+    formatter touching a few lines of a large file diffs only the part between
+    the first and last change.
+    """
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+
+    prefix = 0
+    limit = min(len(old_lines), len(new_lines))
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+
+    old_mid = old_lines[prefix:len(old_lines) - suffix]
+    new_mid = new_lines[prefix:len(new_lines) - suffix]
+    if not old_mid and not new_mid:
+        return []
+
+    offsets = [sum(len(l) for l in old_lines[:prefix])]
+    for line in old_mid:
+        offsets.append(offsets[-1] + len(line))
+
+    hunks = []
+    matcher = difflib.SequenceMatcher(None, old_mid, new_mid)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            hunks.append((offsets[i1], offsets[i2], ''.join(new_mid[j1:j2])))
+    hunks.reverse()
+    return hunks
+
+# view.id() -> (format_backend, digest of the formatter's last output)
+_canonical = {}
+
 class GotoolsFormatOnSave(sublime_plugin.EventListener):
     def on_pre_save(self, view):
         if not GoBuffers.is_go_source(view):
             return
         if not golangconfig.setting_value("format_on_save")[0]:
             return
+        backend = golangconfig.setting_value('format_backend')[0]
+        if _canonical.get(view.id()) == (backend, Buffers.buffer_digest(view)):
+            # Unchanged since the formatter last produced it.
+            return
         view.run_command('gotools_format')
 
+    def on_close(self, view):
+        _canonical.pop(view.id(), None)
+
 class GotoolsFormat(sublime_plugin.TextCommand):
     def __init__(self, view):
         super().__init__(view)
@@ -26,6 +76,7 @@ class GotoolsFormat(sublime_plugin.TextCommand):
         return GoBuffers.is_go_source(self.view)
 
     def run(self, edit):
+        source = Buffers.buffer_text(self.view)
         command = ""
         args = []
         if golangconfig.setting_value('format_backend')[0] == "gofmt":
@@ -35,7 +86,7 @@ class GotoolsFormat(sublime_plugin.TextCommand):
             command = "goimports"
             args = ["-e"]
 
-        stdout, stderr, rc = ToolRunner.run(self.view, command, args, stdin=Buffers.buffer_text(self.view))
+        stdout, stderr, rc = ToolRunner.run(self.view, command, args, stdin=source, feature='format')
 
         # Clear previous syntax error marks
         self.view.erase_regions("mark")
@@ -54,7 +105,7 @@ class GotoolsFormat(sublime_plugin.TextCommand):
         if golangconfig.setting_value('format_backend')[0] == "both":
             command = "gofmt"
             args = ["-e", "-s"]
-            stdout, stderr, rc = ToolRunner.run(self.view, command, args, stdin=stdout.encode('utf-8'))
+            stdout, stderr, rc = ToolRunner.run(self.view, command, args, stdin=stdout.encode('utf-8'), feature='format')
 
         # Clear previous syntax error marks
         self.view.erase_regions("mark")
@@ -72,6 +123,14 @@ class GotoolsFormat(sublime_plugin.TextCommand):
 
         # Everything's good, hide the syntax error panel
         self.phantom_set.update([])
+        self.apply_formatted(edit, source.decode('utf-8'), stdout)
+        _canonical[self.view.id()] = (golangconfig.setting_value('format_backend')[0],
+                                      hashlib.sha1(stdout.encode('utf-8')).hexdigest())
+
+    def apply_formatted(self, edit, old, new):
+        """Patch only the lines the formatter changed, keeping selections, folds and phantoms elsewhere."""
+        for start, end, text in diff_hunks(old, new):
+            self.view.replace(edit, sublime.Region(start, end), text)
 
     # Display an output panel containing the syntax errors, and set gutter marks for each error.
     def show_syntax_errors(self, stderr):
@@ -2,14 +2,75 @@ import sublime
 import sublime_plugin
 import os
 import json
+import threading
 
 from .gotools_util import Buffers
 from .gotools_util import GoBuffers
 from .gotools_util import Logger
+from .gotools_util import PackageGraph
+from .gotools_util import Packages
+from .gotools_util import Scheduler
 from .gotools_util import ToolRunner
+from .gotools_index import SymbolIndex
+from .gotools_type import PrefetchCache
 
 import golangconfig
 
+class PendingLookup():
+  """The in-flight goto-definition lookup of each view.
+
+  A lookup stays relevant while it is the latest one for its view and the
+  view's selection and change count are what they were when it started.
+  """
+
+  STATUS_KEY = 'gotools_goto_def'
+
+  _pending = {}
+  _generation = 0
+
+  @staticmethod
+  def start(view):
+    PendingLookup.cancel(view)
+    PendingLookup._generation += 1
+    request = (PendingLookup._generation, PendingLookup.state(view))
+    PendingLookup._pending[view.id()] = request
+    return request
+
+  @staticmethod
+  def state(view):
+    return (view.change_count(), tuple((r.a, r.b) for r in view.sel()))
+
+  @staticmethod
+  def is_current(view, request):
+    return PendingLookup._pending.get(view.id()) is request and request[1] == PendingLookup.state(view)
+
+  @staticmethod
+  def finish(view, request):
+    """Retire request, returning whether it was still relevant."""
+    current = PendingLookup.is_current(view, request)
+    if PendingLookup._pending.get(view.id()) is request:
+      PendingLookup._pending.pop(view.id(), None)
+      view.erase_status(PendingLookup.STATUS_KEY)
+    return current
+
+  @staticmethod
+  def cancel(view):
+    if PendingLookup._pending.pop(view.id(), None) is not None:
+      Scheduler.cancel((view.id(), 'goto_def'))
+      view.erase_status(PendingLookup.STATUS_KEY)
+
+class GotoolsGotoDefListener(sublime_plugin.EventListener):
+  def on_selection_modified(self, view):
+    request = PendingLookup._pending.get(view.id())
+    if request is not None and not PendingLookup.is_current(view, request):
+      PendingLookup.cancel(view)
+
+  def on_modified(self, view):
+    self.on_selection_modified(view)
+
+  def on_close(self, view):
+    PendingLookup.cancel(view)
+
 class GotoolsGotoDef(sublime_plugin.TextCommand):
   def is_enabled(self):
     return GoBuffers.is_go_source(self.view)
@@ -23,23 +84,57 @@ class GotoolsGotoDef(sublime_plugin.TextCommand):
     # cursor or mouse event location.
     if event:
       filename, row, col, offset = Buffers.location_for_event(self.view, event)
+      point = self.view.window_to_text((event["x"], event["y"]))
     else:
       filename, row, col, offset, offset_end = Buffers.location_at_cursor(self.view)
+      point = self.view.sel()[0].begin()
+
+    # The lookup runs on a thread of its own rather than Sublime's async
+    # thread, where it could queue behind an oracle query or a rename; a
+    # newer lookup, an edit or a cursor move supersedes it (see
+    # GotoolsGotoDefListener), killing its tool.
+    request = PendingLookup.start(self.view)
+    prefetched = PrefetchCache.get_definition(self.view, self.view.word(point))
+    if prefetched:
+      self.open_location(request, *prefetched)
+      return
+
+    self.view.set_status(PendingLookup.STATUS_KEY, "GoTools: finding definition...")
+    threading.Thread(target=self.lookup, args=(request, filename, offset, point), daemon=True).start()
 
+  def lookup(self, request, filename, offset, point):
     backend = golangconfig.setting_value('goto_def_backend')[0] or "godef"
+    indexed = None
+    if golangconfig.setting_value('symbol_index')[0] is not False:
+      try:
+        indexed = SymbolIndex.resolve(self.view, point)
+      except Exception as e:
+        # e.g. go can't be resolved; the backends may still work.
+        Logger.log("symbol index lookup failed: " + str(e))
     try:
-      if backend == "oracle":
+      if indexed:
+        file, row, col = indexed
+      elif backend == "oracle":
         file, row, col = self.get_oracle_location(filename, offset)
       elif backend == "godef":
         file, row, col = self.get_godef_location(filename, offset)
       else:
         Logger.log("Invalid godef backend '" + backend + "' (supported: godef, oracle)")
         Logger.status("Invalid godef configuration; see console log for details")
+        PendingLookup.finish(self.view, request)
         return
     except Exception as e:
-     Logger.status(str(e))
-     return
-    
+      if PendingLookup.finish(self.view, request):
+        Logger.status(str(e))
+      return
+
+    sublime.set_timeout(lambda: self.open_location(request, file, row, col), 0)
+
+  def open_location(self, request, file, row, col):
+    if not PendingLookup.finish(self.view, request):
+      Logger.log("dropping superseded definition " + file + ":" + str(row) + ":" + str(col))
+      return
+
     if not os.path.isfile(file):
       Logger.log("WARN: file indicated by godef not found: " + file)
       Logger.status("godef failed: Please enable debugging and check console log")
@@ -55,21 +150,13 @@ class GotoolsGotoDef(sublime_plugin.TextCommand):
   def get_oracle_location(self, filename, offset):
     args = ["-pos="+filename+":#"+str(offset), "-format=json", "definition"]
 
-    # Build up a package scope contaning all packages the user might have
-    # configured.
-    # TODO: put into a utility
-    package_scope = []
-    for p in golangconfig.setting_value('build_packages')[0]:
-      package_scope.append(os.path.join(golangconfig.setting_value('project_package')[0], p))
-    for p in golangconfig.setting_value('test_packages')[0]:
-      package_scope.append(os.path.join(golangconfig.setting_value('project_package')[0], p))
-    for p in golangconfig.setting_value('tagged_test_packages')[0]:
-      package_scope.append(os.path.join(golangconfig.setting_value('project_package')[0], p))
+    # Definitions only need the package under the cursor loaded.
+    package_scope = PackageGraph.minimal_scope(self.view, "definition", filename, Packages.configured_scope(self.view))
 
     if len(package_scope) > 0:
       args = args + package_scope
 
-    location, err, rc = ToolRunner.run(self.view, "oracle", args)
+    location, err, rc = ToolRunner.run(self.view, "oracle", args, feature='goto_def', key=(self.view.id(), 'goto_def'))
     if rc != 0:
       raise Exception("no definition found")
 
@@ -88,7 +175,8 @@ class GotoolsGotoDef(sublime_plugin.TextCommand):
     return [file, row, col]
 
   def get_godef_location(self, filename, offset):
-    location, err, rc = ToolRunner.run(self.view, "godef", ["-f", filename, "-o", str(offset)])
+    location, err, rc = ToolRunner.run(self.view, "godef", ["-f", filename, "-o", str(offset)],
+      feature='goto_def', key=(self.view.id(), 'goto_def'))
     if rc != 0:
       raise Exception("no definition found")
 
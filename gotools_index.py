@@ -0,0 +1,345 @@
+import sublime
+import sublime_plugin
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+from .gotools_util import GoBuffers
+from .gotools_util import Logger
+from .gotools_util import Packages
+from .gotools_util import ToolRunner
+
+import golangconfig
+
+DECL_RE = re.compile(r'^(func|type|var|const)\b\s*(.*)$')
+RECEIVER_RE = re.compile(r'^\(\s*(?:\w+\s+)?\*?\s*(\w+)[^)]*\)\s*(\w+)')
+NAMES_RE = re.compile(r'^(\w+(?:\s*,\s*\w+)*)')
+BLOCK_ENTRY_RE = re.compile(r'^([ \t]+)(\w+(?:\s*,\s*\w+)*)')
+PACKAGE_RE = re.compile(r'^package\s+(\w+)', re.MULTILINE)
+IMPORT_RE = re.compile(r'^\s*(?:import\s+)?(\w+|\.)?\s*"([^"]+)"')
+QUALIFIED_RE = re.compile(r'(\w+)\.$')
+
+
+def scan_source(text):
+    """Return the package name and top-level declarations of a Go source file.
+
+    Declarations are (name, kind, row, col) tuples with 1-based rows and
+    columns; methods are named Receiver.Method. This is a line scanner rather
+    than a parser: it reads declarations starting at column zero and the
+    entries of parenthesized type, var and const blocks.
+    """
+    match = PACKAGE_RE.search(text)
+    package = match.group(1) if match else ''
+
+    decls = []
+    block = None
+    block_indent = None
+    for row, line in enumerate(text.split('\n'), 1):
+        if block:
+            if line.startswith(')'):
+                block = None
+                continue
+            entry = BLOCK_ENTRY_RE.match(line)
+            if entry:
+                if block_indent is None:
+                    block_indent = entry.group(1)
+                if entry.group(1) == block_indent:
+                    for name in re.finditer(r'\w+', entry.group(2)):
+                        decls.append((name.group(0), block, row, entry.start(2) + name.start() + 1))
+            continue
+
+        match = DECL_RE.match(line)
+        if not match:
+            continue
+        kind, rest = match.groups()
+        offset = match.start(2)
+        if kind == 'func':
+            method = RECEIVER_RE.match(rest)
+            if method:
+                name = method.group(1) + '.' + method.group(2)
+                decls.append((name, 'method', row, offset + method.start(2) + 1))
+                continue
+        if rest.startswith('('):
+            block = kind
+            block_indent = None
+            continue
+        names = NAMES_RE.match(rest)
+        if names:
+            for i, name in enumerate(re.finditer(r'\w+', names.group(1))):
+                if i > 0 and kind in ('func', 'type'):
+                    break
+                decls.append((name.group(0), kind, row, offset + name.start() + 1))
+    return package, decls
+
+
+class SymbolIndex():
+    """Top-level Go declarations by package directory, for instant goto-definition.
+
+    Directories are scanned with `scan_source` and tagged with their package
+    fingerprint, so a rescan only happens when a directory's .go files change.
+    The index is built on a background thread from the window folders and the
+    GOPATH, refreshed for a directory when a file in it is saved, and
+    persisted gzipped under the Sublime cache directory so later sessions only
+    stat what they already know. Saving serializes the whole index, so it is
+    done once by the build thread when a build ends, and otherwise on a timer
+    thread SAVE_DELAY seconds after a change, never on Sublime's threads.
+    """
+
+    VERSION = 1
+    SAVE_DELAY = 5
+
+    # dir -> (fingerprint, package name, {name: [(file, kind, row, col)]})
+    _dirs = {}
+    _lock = threading.Lock()
+    _loaded = False
+    _built = set()
+    _building = 0
+    _dirty = False
+    _save_timer = None
+
+    @staticmethod
+    def path():
+        return os.path.join(sublime.cache_path(), 'GoTools', 'symbols.json.gz')
+
+    @staticmethod
+    def load():
+        with SymbolIndex._lock:
+            if SymbolIndex._loaded:
+                return
+            SymbolIndex._loaded = True
+        try:
+            with gzip.open(SymbolIndex.path(), 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, IOError, ValueError):
+            return
+        if data.get('version') != SymbolIndex.VERSION:
+            return
+
+        dirs = {}
+        for path, (fingerprint, package, decls) in data['dirs'].items():
+            symbols = {}
+            for name, file, kind, row, col in decls:
+                symbols.setdefault(name, []).append((file, kind, row, col))
+            dirs[path] = (fingerprint, package, symbols)
+        with SymbolIndex._lock:
+            for path, entry in dirs.items():
+                SymbolIndex._dirs.setdefault(path, entry)
+
+    @staticmethod
+    def save():
+        with SymbolIndex._lock:
+            SymbolIndex._save_timer = None
+            if not SymbolIndex._dirty:
+                return
+            SymbolIndex._dirty = False
+            # Entries are replaced, never modified, so a shallow copy will do.
+            entries = list(SymbolIndex._dirs.items())
+
+        dirs = {}
+        for path, (fingerprint, package, symbols) in entries:
+            decls = [[name, file, kind, row, col]
+                     for name, locations in symbols.items()
+                     for file, kind, row, col in locations]
+            dirs[path] = [fingerprint, package, decls]
+
+        path = SymbolIndex.path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp'
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump({'version': SymbolIndex.VERSION, 'dirs': dirs}, f, separators=(',', ':'))
+            os.replace(tmp, path)
+        except (OSError, IOError) as e:
+            Logger.error("unable to save symbol index: " + str(e))
+
+    @staticmethod
+    def changed():
+        """Note a change to the index and arrange for it to be saved."""
+        with SymbolIndex._lock:
+            SymbolIndex._dirty = True
+            if SymbolIndex._building or SymbolIndex._save_timer is not None:
+                return
+            timer = threading.Timer(SymbolIndex.SAVE_DELAY, SymbolIndex.save)
+            timer.daemon = True
+            SymbolIndex._save_timer = timer
+        timer.start()
+
+    @staticmethod
+    def refresh_dir(path):
+        """Rescan a directory if its fingerprint changed; return its entry or None."""
+        fingerprint = Packages.fingerprint(path)
+        with SymbolIndex._lock:
+            entry = SymbolIndex._dirs.get(path)
+        if entry is not None and entry[0] == fingerprint:
+            return entry
+
+        if fingerprint is None:
+            with SymbolIndex._lock:
+                SymbolIndex._dirs.pop(path, None)
+            return None
+
+        packages = []
+        symbols = {}
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.go'):
+                continue
+            try:
+                with open(os.path.join(path, name), 'r', encoding='utf-8', errors='replace') as f:
+                    file_package, decls = scan_source(f.read())
+            except (OSError, IOError):
+                continue
+            # Prefer the package name of non-test files over `foo_test`.
+            packages.append((name.endswith('_test.go'), file_package))
+            for decl_name, kind, row, col in decls:
+                symbols.setdefault(decl_name, []).append((name, kind, row, col))
+        package = min(packages)[1] if packages else ''
+
+        entry = (fingerprint, package, symbols)
+        with SymbolIndex._lock:
+            SymbolIndex._dirs[path] = entry
+        SymbolIndex.changed()
+        return entry
+
+    @staticmethod
+    def build(roots):
+        """Index every package directory below roots; meant for a background thread."""
+        SymbolIndex.load()
+        with SymbolIndex._lock:
+            SymbolIndex._building += 1
+        try:
+            for root in roots:
+                for path, dirs, files in os.walk(root):
+                    dirs[:] = [d for d in dirs if not d.startswith(('.', '_')) and d != 'testdata']
+                    if any(f.endswith('.go') for f in files):
+                        SymbolIndex.refresh_dir(path)
+                        # Stay out of the way of the editor's own threads.
+                        time.sleep(0)
+        finally:
+            with SymbolIndex._lock:
+                SymbolIndex._building -= 1
+        Logger.log("symbol index built for " + ", ".join(roots))
+        SymbolIndex.save()
+
+    @staticmethod
+    def build_for_view(view):
+        gopath = ToolRunner.prepare(view, 'go')[1].get('GOPATH', '')
+        roots = [os.path.join(p, 'src') for p in gopath.split(os.pathsep) if p]
+        window = view.window()
+        if window:
+            roots = window.folders() + roots
+        roots = tuple(r for r in roots if os.path.isdir(r))
+        with SymbolIndex._lock:
+            if roots in SymbolIndex._built:
+                return
+            SymbolIndex._built.add(roots)
+        threading.Thread(target=SymbolIndex.build, args=(roots,), daemon=True).start()
+
+    @staticmethod
+    def resolve(view, point):
+        """Resolve a package-qualified identifier at point to (file, row, col).
+
+        Returns None unless the qualifier is an import of the current file and
+        the name has exactly one declaration in the imported package.
+        """
+        word = view.word(point)
+        name = view.substr(word)
+        if not re.match(r'^\w+$', name):
+            return None
+        line_start = view.line(point).begin()
+        qualifier = QUALIFIED_RE.search(view.substr(sublime.Region(line_start, word.begin())))
+        if not qualifier:
+            return None
+
+        path = SymbolIndex.import_dir(view, qualifier.group(1))
+        if path is None:
+            return None
+        entry = SymbolIndex.refresh_dir(path)
+        if entry is None:
+            return None
+        locations = entry[2].get(name, [])
+        if len(locations) != 1:
+            return None
+        file, kind, row, col = locations[0]
+        return os.path.join(path, file), row, col
+
+    @staticmethod
+    def import_dir(view, qualifier):
+        """Find the directory of the import the current file refers to as qualifier."""
+        SymbolIndex.load()
+        env = ToolRunner.prepare(view, 'go')[1]
+        file_dir = os.path.dirname(view.file_name() or '')
+        imports = SymbolIndex.imports(view)
+        for alias, import_path in imports:
+            if alias == qualifier:
+                return SymbolIndex.import_path_dir(import_path, file_dir, env)
+
+        # Package names usually match the last element of the import path,
+        # so check those imports first.
+        unaliased = [p for alias, p in imports if not alias]
+        unaliased.sort(key=lambda p: p.rsplit('/', 1)[-1] != qualifier)
+        for import_path in unaliased:
+            path = SymbolIndex.import_path_dir(import_path, file_dir, env)
+            if path is None:
+                continue
+            entry = SymbolIndex.refresh_dir(path)
+            if entry is not None and entry[1] == qualifier:
+                return path
+        return None
+
+    @staticmethod
+    def import_path_dir(import_path, file_dir, env):
+        # Vendor directories between the file and the root win over GOPATH.
+        current = file_dir
+        while current and os.path.dirname(current) != current:
+            vendored = os.path.join(current, 'vendor', *import_path.split('/'))
+            if os.path.isdir(vendored):
+                return vendored
+            current = os.path.dirname(current)
+        path = Packages.dir_for_import(import_path, env.get('GOPATH', ''))
+        if path is None and env.get('GOROOT'):
+            goroot_path = os.path.join(env['GOROOT'], 'src', *import_path.split('/'))
+            if os.path.isdir(goroot_path):
+                path = goroot_path
+        return path
+
+    @staticmethod
+    def imports(view):
+        """(alias or None, import path) pairs of the imports in a buffer."""
+        text = view.substr(sublime.Region(0, min(view.size(), 1 << 16)))
+        imports = []
+        in_block = False
+        for line in text.split('\n'):
+            stripped = line.strip()
+            if in_block:
+                if stripped.startswith(')'):
+                    in_block = False
+                    continue
+            elif stripped.startswith('import'):
+                if stripped.replace(' ', '').startswith('import('):
+                    in_block = True
+                    continue
+            elif stripped.startswith(('func', 'type', 'var', 'const')):
+                break
+            else:
+                continue
+            match = IMPORT_RE.match(line)
+            if match:
+                imports.append((match.group(1), match.group(2)))
+        return imports
+
+
+class GotoolsSymbolIndexListener(sublime_plugin.EventListener):
+    def on_activated_async(self, view):
+        if not GoBuffers.is_go_source(view) or not view.file_name():
+            return
+        if golangconfig.setting_value('symbol_index', view=view)[0] is False:
+            return
+        SymbolIndex.build_for_view(view)
+
+    def on_post_save_async(self, view):
+        if not GoBuffers.is_go_source(view) or not view.file_name():
+            return
+        SymbolIndex.refresh_dir(os.path.dirname(view.file_name()))
@@ -1,35 +1,177 @@
 import sublime
 import sublime_plugin
+import concurrent.futures
+import functools
+import hashlib
+import html
 import os
 import re
+import threading
 import time
 
+from collections import OrderedDict
+
 from .gotools_util import Logger
+from .gotools_util import Packages
+from .gotools_util import Scheduler
 from .gotools_util import ToolRunner
 
+import golangconfig
+
 LINTERS = [
-    # ('go', ['install', '-v'], "^(.*\.go):(\d+):(\d+):(.*)$", lambda ll: ll['rc'] == 1, lambda stderr, stdout: stderr),
-    ('go', ['vet'], "^(.*\.go):(\d+):(\d+:)?(.*)$", lambda ll: ll['rc'] == 1, lambda stderr, stdout: stderr),
-    ('golint', [], "^(.*\.go):(\d+):(\d+:)(.*)$", lambda ll: len(ll['stdout']) > 0, lambda stderr, stdout: stdout),
+    # ('go', ['install', '-v'], re.compile("^(.*\.go):(\d+):(\d+):(.*)$"), lambda ll: ll['rc'] == 1, lambda stderr, stdout: stderr),
+    ('go', ['vet'], re.compile("^(.*\.go):(\d+):(\d+:)?(.*)$"), lambda ll: ll['rc'] == 1, lambda stderr, stdout: stderr),
+    ('golint', [], re.compile("^(.*\.go):(\d+):(\d+:)(.*)$"), lambda ll: len(ll['stdout']) > 0, lambda stderr, stdout: stdout),
 ]
 
+# Seconds each linter may run before it is killed.
+LINT_TIMEOUT = 30
 
-class GotoolsLint(sublime_plugin.ViewEventListener):
-    @classmethod
-    def is_applicable(cls, settings):
-        return settings.get('syntax') == 'Packages/GoTools/GoTools.tmLanguage'
+# Linters run side by side; the scheduler still caps how many processes run.
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
-    def __init__(self, view):
-        self.view = view
-        self.phantom_set = sublime.PhantomSet(view)
+# String and rune literals are kept whole; comments and runs of whitespace
+# only count as a separator.
+GO_LAYOUT_RE = re.compile(r'"(?:\\.|[^"\\\n])*"|`[^`]*`|\'(?:\\.|[^\'\\\n])*\'|//[^\n]*|/\*.*?\*/|\s+', re.DOTALL)
+
+
+def token_digest(text):
+    """Digest Go source such that edits to whitespace or comments don't change it.
+
+    Separators are reduced to a space, or a newline when they span one,
+    since Go inserts semicolons at line ends.
+    """
+    digest = hashlib.sha1()
+    # Separator owed before the next token; none before the first.
+    pending = None
+    started = False
+    last = 0
+    for match in GO_LAYOUT_RE.finditer(text):
+        token = match.group(0)
+        if match.start() > last:
+            if pending:
+                digest.update(pending)
+            pending = None
+            started = True
+            digest.update(text[last:match.start()].encode('utf-8'))
+        if token[0] in '"`\'':
+            if pending:
+                digest.update(pending)
+            pending = None
+            started = True
+            digest.update(token.encode('utf-8'))
+        elif started:
+            pending = b'\n' if '\n' in token or pending == b'\n' else b' '
+        last = match.end()
+    if last < len(text):
+        if pending:
+            digest.update(pending)
+        digest.update(text[last:].encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LintCache():
+    """Raw linter output per package directory.
+
+    Linters read the package from disk, so their output only changes when
+    the package's files do. Entries are tagged with the package fingerprint
+    they were produced for and are ignored once it no longer matches.
+    """
+
+    MAX_PACKAGES = 256
+
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(path, fingerprint, linter):
+        with LintCache._lock:
+            entry = LintCache._entries.get(path)
+            if entry is None or entry[0] != fingerprint:
+                return None
+            LintCache._entries.move_to_end(path)
+            return entry[1].get(linter)
+
+    @staticmethod
+    def put(path, fingerprint, linter, output):
+        with LintCache._lock:
+            entry = LintCache._entries.get(path)
+            if entry is None or entry[0] != fingerprint:
+                entry = (fingerprint, {})
+                LintCache._entries[path] = entry
+            entry[1][linter] = output
+            LintCache._entries.move_to_end(path)
+            while len(LintCache._entries) > LintCache.MAX_PACKAGES:
+                LintCache._entries.popitem(last=False)
+
+
+def run_linter(prepared, path, index, fingerprint, feature='lint'):
+    """Run LINTERS[index] over the package in path and cache its output.
+
+    Returns (stdout, stderr, rc), or None if a newer run of the same linter
+    over the same package superseded it.
+    """
+    cmd, args = LINTERS[index][0], LINTERS[index][1]
+    # Linters report problems through their exit status, so failed runs are
+    # results worth keeping too.
+    stdout, stderr, rc = ToolRunner.run_prepared(prepared, args, cwd=path, timeout=LINT_TIMEOUT,
+                                                 feature=feature, key=(feature, path, cmd) + tuple(args),
+                                                 cache_key=fingerprint, cache_failures=True)
+    if rc == ToolRunner.CANCELLED:
+        return None
+    if fingerprint:
+        LintCache.put(path, fingerprint, ' '.join([cmd] + args), (stdout, stderr, rc))
+    return stdout, stderr, rc
+
+
+class PackageLinter():
+    """Lints one package directory on behalf of every open view in it.
 
+    Views in the same directory share a debounce timer and a single
+    in-flight run per linter. Each linter's raw output is handed to every
+    registered view, which keeps the diagnostics for its own file.
+    """
+
+    _packages = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.listeners = {}
         self.timeout_scheduled = False
         self.last_modified = 0
+        # Whether the pending run was asked for by a save.
+        self.forced = False
+        # Linter index -> (fingerprint, future) of the latest run.
+        self.current = {}
 
-        self.prepared = {l[0]: ToolRunner.prepare(view, l[0]) for l in LINTERS}
+    @staticmethod
+    def for_path(path):
+        with PackageLinter._lock:
+            package = PackageLinter._packages.get(path)
+            if package is None:
+                package = PackageLinter(path)
+                PackageLinter._packages[path] = package
+            return package
 
-    def on_modified(self):
+    def register(self, listener):
+        with self.lock:
+            self.listeners[listener.view.id()] = listener
+
+    def unregister(self, listener):
+        with self.lock:
+            self.listeners.pop(listener.view.id(), None)
+            empty = not self.listeners
+        if empty:
+            with PackageLinter._lock:
+                if PackageLinter._packages.get(self.path) is self:
+                    del PackageLinter._packages[self.path]
+
+    def touch(self, force=False):
         self.last_modified = time.time()
+        if force:
+            self.forced = True
         if self.timeout_scheduled:
             return
 
@@ -42,48 +184,372 @@ class GotoolsLint(sublime_plugin.ViewEventListener):
             sublime.set_timeout_async(self.lint, 500)
             return
 
-        phantoms = []
-        for l in LINTERS:
-            phantoms.extend(self._run_cmd_or_fail(*l, **{'include_other_files': False}))
-
-        self.phantom_set.update(phantoms)
         self.timeout_scheduled = False
+        with self.lock:
+            listeners = list(self.listeners.values())
+        if not listeners:
+            return
+
+        forced, self.forced = self.forced, False
+        # Every view's digest is brought up to date, hence the list.
+        changed = [l for l in listeners if l.tokens_changed()]
+        if not forced and not changed:
+            Logger.log("skipping lint of " + self.path + ": only whitespace or comments changed")
+            return
+
+        view = listeners[0].view
+        content = golangconfig.setting_value('lint_cache_content_hash', view=view)[0]
+        fingerprint = Packages.fingerprint(self.path, content=bool(content))
+
+        for index, l in enumerate(LINTERS):
+            cmd, args = l[0], l[1]
+            linter = ' '.join([cmd] + args)
+            cached = LintCache.get(self.path, fingerprint, linter) if fingerprint else None
+            with self.lock:
+                if cached is None:
+                    current = self.current.get(index)
+                    if current and current[0] == fingerprint and not current[1].done():
+                        # Already linting this exact package state.
+                        continue
+                    future = _pool.submit(run_linter, ToolRunner.prepare(listeners[0].view, cmd), self.path, index, fingerprint)
+                    self.current[index] = (fingerprint, future)
+                else:
+                    self.current.pop(index, None)
+            if cached is None:
+                future.add_done_callback(functools.partial(self._linter_done, index))
+            else:
+                self._fan_out(index, cached)
+
+    def _linter_done(self, index, future):
+        with self.lock:
+            current = self.current.get(index)
+            if current is None or current[1] is not future:
+                # Superseded by a later run.
+                return
+        try:
+            output = future.result()
+        except Exception as e:
+            Logger.error("{0} failed: {1}".format(LINTERS[index][0], e))
+            return
+        if output is not None:
+            self._fan_out(index, output)
+
+    def _fan_out(self, index, output):
+        with self.lock:
+            listeners = list(self.listeners.values())
+        for listener in listeners:
+            listener.apply(index, output)
+
+
+class DiagnosticStore():
+    """Diagnostics of one view, each anchored to a region that moves with edits.
+
+    Updating a linter's diagnostics keeps the anchors of those it still
+    reports at the same place with the same message and only adds and
+    erases regions for the rest, so an unchanged lint result costs no
+    region churn and the phantoms built from it compare equal.
+
+    Linters report rows of the file on disk, which only locate anything in
+    the buffer while it has no unsaved changes. For a modified buffer,
+    `keep` updates which diagnostics exist without touching the anchors
+    that edits have moved.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.next_id = 0
+        # Linter index -> {region key: message}
+        self.entries = {}
+
+    def update(self, index, diagnostics):
+        """Replace a linter's diagnostics with (row, col, message) tuples."""
+        # (point, message) -> region keys; edits can bring several anchors
+        # with the same message together.
+        old = {}
+        for key, message in self.entries.get(index, {}).items():
+            regions = self.view.get_regions(key)
+            if regions:
+                old.setdefault((regions[0].a, message), []).append(key)
+            else:
+                self.view.erase_regions(key)
+
+        entries = {}
+        for row, col, message in diagnostics:
+            point = self.view.text_point(row, col)
+            keys = old.get((point, message))
+            key = keys.pop() if keys else None
+            if key is None:
+                self.next_id += 1
+                key = 'gotools_lint.{0}'.format(self.next_id)
+                self.view.add_regions(key, [sublime.Region(point)], '', '', sublime.HIDDEN)
+            entries[key] = message
 
-    def _run_cmd_or_fail(self, cmd, args, file_regex, failure_test, failures, include_other_files):
+        for keys in old.values():
+            for key in keys:
+                self.view.erase_regions(key)
+        self.entries[index] = entries
+
+    def keep(self, index, diagnostics):
+        """Like update, but only for diagnostics that already have an anchor.
+
+        Anchors are matched by message, in buffer order. Diagnostics without
+        one are left for the next update against a saved buffer.
+        """
+        wanted = {}
+        for row, col, message in diagnostics:
+            wanted[message] = wanted.get(message, 0) + 1
+
+        anchored = {}
+        for key, message in self.entries.get(index, {}).items():
+            regions = self.view.get_regions(key)
+            if regions:
+                anchored.setdefault(message, []).append((regions[0].a, key))
+            else:
+                self.view.erase_regions(key)
+
+        entries = {}
+        for message, anchors in anchored.items():
+            anchors.sort()
+            count = wanted.get(message, 0)
+            for point, key in anchors[:count]:
+                entries[key] = message
+            for point, key in anchors[count:]:
+                self.view.erase_regions(key)
+        self.entries[index] = entries
+
+    def phantoms(self):
+        anchored = []
+        for index in sorted(self.entries):
+            for key, message in self.entries[index].items():
+                regions = self.view.get_regions(key)
+                if regions:
+                    anchored.append((regions[0].a, index, message))
+        anchored.sort(key=lambda a: a[:2])
+        return [sublime.Phantom(sublime.Region(point),
+                                '<div class="warning">^ {0}</div>'.format(html.escape(message)),
+                                sublime.LAYOUT_BELOW)
+                for point, index, message in anchored]
+
+
+class GotoolsLint(sublime_plugin.ViewEventListener):
+    @classmethod
+    def is_applicable(cls, settings):
+        return settings.get('syntax') == 'Packages/GoTools/GoTools.tmLanguage'
+
+    def __init__(self, view):
+        self.view = view
+        self.phantom_set = sublime.PhantomSet(view)
+
+        # Diagnostics from the latest finished run of each linter.
+        self.lock = threading.Lock()
+        self.store = DiagnosticStore(view)
+        self.tokens = None
+
+        self.package = None
+        if view.file_name():
+            self.join_package()
+            # Replay whatever is cached for this package without running anything.
+            sublime.set_timeout_async(self.replay, 0)
+
+    def join_package(self):
         path = os.path.dirname(self.view.file_name())
-        stdout, stderr, rc = ToolRunner.run_prepared(self.prepared[cmd], args, cwd=path)
-
-        if failure_test(locals()):
-            # Show syntax errors and bail
-            return self.show_syntax_errors('## {0} ##'.format(' '.join([cmd] + args)),
-                                           failures(stderr, stdout),
-                                           file_regex,
-                                           include_other_files)
-        return []
-
-    def show_syntax_errors(self, header, stderr, file_regex, include_other_files):
-        """Display an output panel containing the syntax errors, and set gutter marks for each error."""
+        if self.package and self.package.path == path:
+            return
+        if self.package:
+            self.package.unregister(self)
+        self.package = PackageLinter.for_path(path)
+        self.package.register(self)
+
+    def on_close(self):
+        if self.package:
+            self.package.unregister(self)
+
+    def on_post_save_async(self):
+        self.join_package()
+        if self.package:
+            self.package.touch(force=True)
+
+    def on_modified(self):
+        if self.package:
+            self.package.touch()
+
+    def tokens_changed(self):
+        """Whether the buffer changed other than in whitespace and comments since last asked."""
+        digest = token_digest(self.view.substr(sublime.Region(0, self.view.size())))
+        changed = digest != self.tokens
+        self.tokens = digest
+        return changed
+
+    def replay(self):
+        path = self.package.path
+        content = golangconfig.setting_value('lint_cache_content_hash', view=self.view)[0]
+        fingerprint = Packages.fingerprint(path, content=bool(content))
+        if not fingerprint:
+            return
+        for index, l in enumerate(LINTERS):
+            cached = LintCache.get(path, fingerprint, ' '.join([l[0]] + l[1]))
+            if cached is not None:
+                self.apply(index, cached)
+
+    def apply(self, index, output):
+        """Merge one linter's output for the package into this view's diagnostics."""
+        cmd, args, file_regex, failure_test, failures = LINTERS[index]
+        stdout, stderr, rc = output
+
+        diagnostics = []
+        if failure_test({'stdout': stdout, 'stderr': stderr, 'rc': rc}):
+            diagnostics = self.parse_diagnostics(failures(stderr, stdout), file_regex)
+
+        # Merge as each linter finishes rather than waiting for the slowest.
+        with self.lock:
+            if self.view.is_dirty():
+                self.store.keep(index, diagnostics)
+            else:
+                self.store.update(index, diagnostics)
+            phantoms = self.store.phantoms()
+        self.phantom_set.update(phantoms)
+
+    def parse_diagnostics(self, output, file_regex):
+        """(row, col, message) for each line of linter output about this view's file."""
         file_name = os.path.basename(self.view.file_name())
 
-        phantoms = []
-        for error in stderr.splitlines():
+        diagnostics = []
+        for error in output.splitlines():
             if file_name not in error:
                 continue
 
-            match = re.match(file_regex, error)
-            print(match.groups())
+            match = file_regex.match(error)
             if not match or not match.group(2):
                 Logger.log("skipping unrecognizable error:\n" + error + "\nmatch:" + str(match))
                 continue
 
             row = int(match.group(2)) - 1
             column = 0
-            if len(match.groups()) == 4:
+            if match.group(3):
                 column = int(match.group(3)[:-1]) - 1
 
-            error = '<div class="warning">^ {}</div>'.format(match.groups()[-1].strip())
+            diagnostics.append((row, column, match.groups()[-1].strip()))
+
+        return diagnostics
+
+
+class GotoolsLintProjectCommand(sublime_plugin.WindowCommand):
+    """Lint every build and test package of the project into the gotools_lint panel.
+
+    Packages are linted side by side, one per core, and each package's
+    problems are appended to the panel as soon as it finishes. Output goes
+    through LintCache, so packages unchanged since they were last linted
+    aren't linted again.
+    """
+
+    RESULT_REGEX = "^(.*\.go):(\d+):(\d+): (.*)$"
 
-            pt = self.view.text_point(row, column)
-            phantoms.append(sublime.Phantom(sublime.Region(pt), error, sublime.LAYOUT_BELOW))
+    # The sweep currently filling the panel of each window.
+    _sweeps = {}
 
-        return phantoms
+    def is_enabled(self):
+        return self.window.active_view() is not None
+
+    def run(self):
+        view = self.window.active_view()
+        sweep = object()
+        GotoolsLintProjectCommand._sweeps[self.window.id()] = sweep
+        # A sweep can take minutes; it gets a thread of its own rather than
+        # holding up everything else on Sublime's async thread.
+        threading.Thread(target=self.lint_project, args=(view, sweep), daemon=True).start()
+
+    def lint_project(self, view, sweep):
+        scope = Packages.configured_scope(view)
+        if not scope:
+            Logger.status("no build_packages or test_packages configured")
+            return
+        gopath = ToolRunner.prepare(view, 'go')[1].get('GOPATH', '')
+        paths = self.package_dirs(scope, gopath)
+        content = bool(golangconfig.setting_value('lint_cache_content_hash', view=view)[0])
+        prepared = [ToolRunner.prepare(view, l[0]) for l in LINTERS]
+
+        panel = self.window.create_output_panel('gotools_lint')
+        panel.set_scratch(True)
+        panel.settings().set("result_file_regex", self.RESULT_REGEX)
+        panel.run_command("select_all")
+        panel.run_command("right_delete")
+        panel.run_command('append', {'characters': "## linting {0} packages ##\n".format(len(paths))})
+        self.window.run_command("show_panel", {"panel": "output.gotools_lint"})
+
+        done = 0
+        problems = 0
+        workers = Scheduler.batch_processes()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.lint_package, sweep, prepared, path, content) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                if GotoolsLintProjectCommand._sweeps.get(self.window.id()) is not sweep:
+                    for f in futures:
+                        f.cancel()
+                    return
+                try:
+                    lines = future.result()
+                except Exception as e:
+                    lines = []
+                    Logger.error("lint failed: {0}".format(e))
+                done += 1
+                problems += len(lines)
+                self.append(panel, sweep, lines, "linted {0}/{1} packages, {2} problems".format(done, len(paths), problems))
+
+        self.append(panel, sweep, ["## {0} problems in {1} packages ##".format(problems, len(paths))], None)
+        Logger.status("lint finished: {0} problems in {1} packages".format(problems, len(paths)))
+
+    def lint_package(self, sweep, prepared, path, content):
+        """Problems in one package, as file:line:col: message lines."""
+        if GotoolsLintProjectCommand._sweeps.get(self.window.id()) is not sweep:
+            return []
+        fingerprint = Packages.fingerprint(path, content=content)
+        lines = []
+        for index, l in enumerate(LINTERS):
+            cmd, args, file_regex, failure_test, failures = l
+            output = LintCache.get(path, fingerprint, ' '.join([cmd] + args)) if fingerprint else None
+            if output is None:
+                output = run_linter(prepared[index], path, index, fingerprint, feature='lint_project')
+                if output is None:
+                    continue
+            stdout, stderr, rc = output
+            if not failure_test({'stdout': stdout, 'stderr': stderr, 'rc': rc}):
+                continue
+            for error in failures(stderr, stdout).splitlines():
+                match = file_regex.match(error)
+                if not match or not match.group(2):
+                    continue
+                column = match.group(3)[:-1] if match.group(3) else '1'
+                lines.append("{0}:{1}:{2}: {3}".format(os.path.normpath(os.path.join(path, match.group(1))),
+                                                       match.group(2), column, match.groups()[-1].strip()))
+        return lines
+
+    def append(self, panel, sweep, lines, status):
+        def append():
+            if GotoolsLintProjectCommand._sweeps.get(self.window.id()) is not sweep:
+                return
+            if lines:
+                panel.run_command('append', {'characters': "\n".join(lines) + "\n", 'scroll_to_end': False})
+            if status:
+                Logger.status(status)
+        sublime.set_timeout(append, 0)
+
+    @staticmethod
+    def package_dirs(scope, gopath):
+        """Source directories of the packages in scope; `/...` patterns take every package below."""
+        paths = []
+        for import_path in scope:
+            recursive = import_path.endswith('/...')
+            if recursive:
+                import_path = import_path[:-len('/...')]
+            path = Packages.dir_for_import(import_path, gopath)
+            if path is None:
+                Logger.log("no source directory for " + import_path)
+                continue
+            if not recursive:
+                paths.append(path)
+                continue
+            for sub, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')) and d not in ('testdata', 'vendor'))
+                if any(f.endswith('.go') for f in files):
+                    paths.append(sub)
+        return sorted(set(paths))
@@ -1,21 +1,55 @@
 import sublime
 import sublime_plugin
 import os
+import re
+import threading
+
+from collections import OrderedDict
 
 from .gotools_util import Buffers
 from .gotools_util import GoBuffers
 from .gotools_util import Logger
+from .gotools_util import PackageGraph
+from .gotools_util import Packages
 from .gotools_util import ToolRunner
 
-import golangconfig
+class OracleCache():
+    """LRU of oracle output keyed by mode, position, scope and source fingerprint.
 
-class GotoolsOracleCommand(sublime_plugin.TextCommand):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    oracle has no resident mode to keep a loaded program warm between
+    queries, so instead repeated queries are answered from here for as long
+    as the Go sources under the scope are unchanged on disk. Positions are
+    normalized to the start of the identifier under the cursor, so asking
+    again from elsewhere in the same identifier also hits.
+    """
+
+    MAX_ENTRIES = 64
+
+    _entries = OrderedDict()
+    _lock = threading.Lock()
 
-        if self.is_enabled():
-            self.oracle = ToolRunner.prepare(self.view, 'oracle')
+    @staticmethod
+    def get(key):
+        with OracleCache._lock:
+            output = OracleCache._entries.get(key)
+            if output is not None:
+                OracleCache._entries.move_to_end(key)
+            return output
 
+    @staticmethod
+    def put(key, output):
+        with OracleCache._lock:
+            OracleCache._entries[key] = output
+            OracleCache._entries.move_to_end(key)
+            while len(OracleCache._entries) > OracleCache.MAX_ENTRIES:
+                OracleCache._entries.popitem(last=False)
+
+STATUS_KEY = 'gotools_oracle'
+
+# window.id() -> token of the query currently streaming into its panel
+_streams = {}
+
+class GotoolsOracleCommand(sublime_plugin.TextCommand):
     def is_enabled(self):
         return GoBuffers.is_go_source(self.view)
 
@@ -25,60 +59,104 @@ class GotoolsOracleCommand(sublime_plugin.TextCommand):
             return
 
         filename, row, col, offset, offset_end = Buffers.location_at_cursor(self.view)
+        word = self.view.word(self.view.sel()[0])
+        if re.match(r'^\w+$', self.view.substr(word)):
+            offset = Buffers.offset_at_point(self.view, word.begin())
         pos = filename + ":#" + str(offset)
 
-        # Build up a package scope contaning all packages the user might have
-        # configured.
-        # TODO: put into a utility
-        package_scope = []
-        project_pkg = golangconfig.setting_value('project_package')[0] or ""
-        for p in golangconfig.setting_value('build_packages'):
-            if p:
-                package_scope.append(os.path.join(project_pkg, p))
-        for p in golangconfig.setting_value('test_packages'):
-            if p:
-                package_scope.append(os.path.join(project_pkg, p))
-        for p in golangconfig.setting_value('tagged_test_packages'):
-            if p:
-                package_scope.append(os.path.join(project_pkg, p))
+        configured = Packages.configured_scope(self.view)
+        scope = lambda mode: PackageGraph.minimal_scope(self.view, mode, filename, configured)
 
         sublime.active_window().run_command("hide_panel", {"panel": "output.gotools_oracle"})
 
         if command == "callees":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("callees", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("callees", pos, scope("callees")), 0)
         if command == "callers":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("callers", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("callers", pos, scope("callers")), 0)
         if command == "callstack":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("callstack", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("callstack", pos, scope("callstack")), 0)
         if command == "describe":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("describe", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("describe", pos, scope("describe")), 0)
         if command == "freevars":
-            pos = filename + ":#" + str(offset) + "," + "#" + str(offset_end)
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("freevars", pos, package_scope), 0)
+            pos = filename + ":#" + str(Buffers.offset_at_cursor(self.view)[0]) + "," + "#" + str(offset_end)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("freevars", pos, scope("freevars")), 0)
         if command == "implements":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("implements", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("implements", pos, scope("implements")), 0)
         if command == "peers":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("peers", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("peers", pos, scope("peers")), 0)
         if command == "referrers":
-            sublime.set_timeout_async(lambda: self.do_plain_oracle("referrers", pos, package_scope), 0)
+            sublime.set_timeout_async(lambda: self.do_plain_oracle("referrers", pos, scope("referrers")), 0)
 
     def do_plain_oracle(self, mode, pos, package_scope=[], regex="^(.*):(\d+)[.:](\d+)[:-](.*)$"):
+        fingerprint = Packages.source_fingerprint(self.view, 'oracle', pos.split(':#', 1)[0], package_scope)
+        key = (mode, pos, tuple(package_scope), fingerprint)
+        window = self.view.window()
+        output = OracleCache.get(key)
+        if output is not None:
+            Logger.status("oracle " + mode + " finished")
+            _streams.pop(window.id(), None)
+            panel = self.open_panel(window, regex)
+            panel.run_command('append', {'characters': output})
+            window.run_command("show_panel", {"panel": "output.gotools_oracle"})
+            return
+
         Logger.status("running oracle " + mode + "...")
         args = ["-pos=" + pos, "-format=plain", mode]
         if len(package_scope) > 0:
             args = args + package_scope
-        output, err, rc = ToolRunner.run_prepared(self.oracle, args, timeout=60)
+
+        # Results are appended to the panel as oracle prints them, so the
+        # first ones can be followed while the query is still running. A
+        # newer query on the same window takes the panel over.
+        token = object()
+        _streams[window.id()] = token
+        panel = self.open_panel(window, regex)
+        result_re = re.compile(regex, re.MULTILINE)
+        results = [0]
+
+        def on_output(chunk):
+            results[0] += len(result_re.findall(chunk))
+            count = results[0]
+            def append():
+                if _streams.get(window.id()) is not token:
+                    return
+                panel.run_command('append', {'characters': chunk, 'scroll_to_end': False})
+                self.view.set_status(STATUS_KEY, "oracle {0}: {1} results...".format(mode, count))
+            sublime.set_timeout(append, 0)
+
+        # The fingerprint only covers the scope, while answers can point into
+        # any package; a result saved in an earlier session is only reused if
+        # none of the files it names has changed since.
+        def unchanged(output, started):
+            for path in set(m.group(1) for m in result_re.finditer(output)):
+                try:
+                    if os.stat(path).st_mtime >= started:
+                        return False
+                except OSError:
+                    return False
+            return True
+
+        sublime.set_timeout(lambda: window.run_command("show_panel", {"panel": "output.gotools_oracle"}), 0)
+        try:
+            output, err, rc = ToolRunner.stream(self.view, 'oracle', args, on_output=on_output, timeout=60,
+                                                feature='oracle', key=(self.view.id(), 'oracle'),
+                                                cache_key=fingerprint, cache_check=unchanged)
+        finally:
+            sublime.set_timeout(lambda: self.view.erase_status(STATUS_KEY), 0)
+        if rc == ToolRunner.CANCELLED:
+            return
         Logger.log("oracle " + mode + " output: " + output.rstrip())
 
         if rc != 0:
             Logger.status("oracle call failed (" + str(rc) + "): " + output.strip())
             return
-        Logger.status("oracle " + mode + " finished")
+        OracleCache.put(key, output)
+        Logger.status("oracle {0} finished ({1} results)".format(mode, results[0]))
 
-        panel = self.view.window().create_output_panel('gotools_oracle')
+    def open_panel(self, window, regex):
+        panel = window.create_output_panel('gotools_oracle')
         panel.set_scratch(True)
         panel.settings().set("result_file_regex", regex)
         panel.run_command("select_all")
         panel.run_command("right_delete")
-        panel.run_command('append', {'characters': output})
-        self.view.window().run_command("show_panel", {"panel": "output.gotools_oracle"})
+        return panel
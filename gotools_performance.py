@@ -0,0 +1,43 @@
+import sublime
+import sublime_plugin
+import json
+import os
+
+from .gotools_util import Logger
+from .gotools_util import Metrics
+
+
+class GotoolsPerformanceReportCommand(sublime_plugin.WindowCommand):
+    """Show tool latencies and counters collected this session in an output panel."""
+
+    def run(self, reset=False):
+        report = Metrics.report()
+        if reset:
+            Metrics.reset()
+
+        panel = self.window.create_output_panel('gotools_performance')
+        panel.set_scratch(True)
+        panel.run_command("select_all")
+        panel.run_command("right_delete")
+        panel.run_command('append', {'characters': report})
+        self.window.run_command("show_panel", {"panel": "output.gotools_performance"})
+
+
+class GotoolsExportPerformanceReportCommand(sublime_plugin.WindowCommand):
+    """Write the per tool and feature summaries as JSON lines."""
+
+    def run(self):
+        path = os.path.join(sublime.cache_path(), 'GoTools', 'performance.jsonl')
+        self.window.show_input_panel("Export GoTools metrics to:", path, self.export, None, None)
+
+    def export(self, path):
+        path = os.path.expanduser(path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                for summary in Metrics.snapshot():
+                    f.write(json.dumps(summary) + '\n')
+        except (OSError, IOError) as e:
+            Logger.status("unable to export metrics: " + str(e))
+            return
+        Logger.status("exported metrics to " + path)
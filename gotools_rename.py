@@ -1,19 +1,163 @@
 import sublime
 import sublime_plugin
 import os
+import re
+import threading
 
 from .gotools_util import Buffers
 from .gotools_util import GoBuffers
 from .gotools_util import Logger
 from .gotools_util import ToolRunner
 
-class GotoolsRenameCommand(sublime_plugin.TextCommand):
-  def __init__(self, *args, **kwargs):
-    super().__init__(*args, **kwargs)
+import golangconfig
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def parse_unified_diff(diff):
+  """Split `diff -u` output into (file name, hunks) pairs.
+
+  The file name comes from the `---` header, which is the original file
+  when gorename runs in diff mode. Hunks are (old_start, old_count,
+  new_start, lines) tuples where lines are (op, text) pairs, op is one of
+  ' ', '-' and '+', and text keeps its trailing newline unless the diff
+  marks it as missing.
+  """
+  files = []
+  hunks = None
+  lines = None
+  old_left = new_left = 0
+  for line in diff.split('\n'):
+    if line.startswith('\\') and lines:
+      # "\ No newline at end of file" applies to the line before it.
+      op, text = lines[-1]
+      lines[-1] = (op, text[:-1])
+      continue
+
+    if old_left > 0 or new_left > 0:
+      op = line[:1]
+      if op not in (' ', '-', '+'):
+        # A truncated hunk; drop what is left of it.
+        old_left = new_left = 0
+      else:
+        lines.append((op, line[1:] + '\n'))
+        if op != '+':
+          old_left -= 1
+        if op != '-':
+          new_left -= 1
+        continue
+
+    if line.startswith('--- '):
+      hunks = []
+      files.append((line[4:].split('\t', 1)[0], hunks))
+      lines = None
+    elif line.startswith('@@') and hunks is not None:
+      match = HUNK_RE.match(line)
+      if not match:
+        continue
+      old_start, old_count, new_start, new_count = match.groups()
+      old_left = 1 if old_count is None else int(old_count)
+      new_left = 1 if new_count is None else int(new_count)
+      lines = []
+      hunks.append((int(old_start), old_left, int(new_start), lines))
+  return files
+
+def diff_edits(hunks):
+  """Reduce hunks to the smallest edits that make the old text into the new.
+
+  Returns (edits, preview). Edits are [row, col, end_row, end_col, old, new]
+  lists with 0-based rows and character columns into the old text, in
+  document order. Runs of changed lines that pair up one to one are narrowed
+  to the characters that differ, which for a rename is just the identifier.
+  Preview entries are (row, col, line) for every changed line of the new
+  text, with 1-based rows and columns.
+  """
+  edits = []
+  preview = []
+  for old_start, old_count, new_start, lines in hunks:
+    row = old_start - 1 if old_count else old_start
+    new_row = new_start - 1
+    removed = []
+    added = []
+    for op, text in lines + [(' ', None)]:
+      if op == '-':
+        removed.append(text)
+        continue
+      if op == '+':
+        added.append(text)
+        continue
+
+      if removed or added:
+        if len(removed) == len(added):
+          for i, (old, new) in enumerate(zip(removed, added)):
+            prefix = 0
+            limit = min(len(old), len(new))
+            while prefix < limit and old[prefix] == new[prefix]:
+              prefix += 1
+            suffix = 0
+            limit -= prefix
+            while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+              suffix += 1
+            edits.append([row + i, prefix, row + i, len(old) - suffix,
+                          old[prefix:len(old) - suffix], new[prefix:len(new) - suffix]])
+            preview.append((new_row + i + 1, prefix + 1, new.rstrip('\n')))
+        else:
+          edits.append([row, 0, row + len(removed), 0, ''.join(removed), ''.join(added)])
+          preview.extend((new_row + i + 1, 1, new.rstrip('\n')) for i, new in enumerate(added))
+        row += len(removed)
+        new_row += len(added)
+        removed = []
+        added = []
+      row += 1
+      new_row += 1
+  return edits, preview
+
+def apply_edits(text, edits):
+  """Apply edits from `diff_edits` to text; None if text isn't what they expect."""
+  starts = [0]
+  for line in text.split('\n'):
+    starts.append(starts[-1] + len(line) + 1)
+
+  def offset(row, col):
+    if row >= len(starts) - 1:
+      return len(text)
+    return min(starts[row] + col, len(text))
 
-    if self.is_enabled():
-        self.gorename = ToolRunner.prepare(self.view, 'gorename')
+  pieces = []
+  end = len(text)
+  for row, col, end_row, end_col, old, new in reversed(edits):
+    a, b = offset(row, col), offset(end_row, end_col)
+    if text[a:b] != old or b > end:
+      return None
+    pieces.append(text[b:end])
+    pieces.append(new)
+    end = a
+  pieces.append(text[:end])
+  return ''.join(reversed(pieces))
 
+def edit_regions(view, edits):
+  """The regions of a view edits apply to; None if the buffer doesn't match them."""
+  regions = []
+  for row, col, end_row, end_col, old, new in edits:
+    region = sublime.Region(view.text_point(row, 0) + col, view.text_point(end_row, 0) + end_col)
+    if end_row >= view.rowcol(view.size())[0] + 1:
+      region = sublime.Region(region.a, view.size())
+    if view.substr(region) != old:
+      return None
+    regions.append(region)
+  return regions
+
+class GotoolsApplyEditsCommand(sublime_plugin.TextCommand):
+  """Apply `diff_edits` edits to the buffer as a single undoable change."""
+
+  def run(self, edit, edits=[]):
+    regions = edit_regions(self.view, edits)
+    if regions is None:
+      Logger.status("{0} changed during rename; not renamed".format(self.view.file_name()))
+      return
+    for region, e in reversed(list(zip(regions, edits))):
+      self.view.replace(edit, region, e[5])
+
+class GotoolsRenameCommand(sublime_plugin.TextCommand):
   def is_enabled(self):
     return GoBuffers.is_go_source(self.view)
 
@@ -21,7 +165,10 @@ class GotoolsRenameCommand(sublime_plugin.TextCommand):
     self.view.window().show_input_panel("Go rename:", "", self.do_rename_async, None, None)
 
   def do_rename_async(self, name):
-    sublime.set_timeout_async(lambda: self.do_rename(name), 0)
+    if golangconfig.setting_value('rename_in_buffers')[0] is False:
+      sublime.set_timeout_async(lambda: self.do_rename(name), 0)
+    else:
+      sublime.set_timeout_async(lambda: self.do_rename_diff(name), 0)
 
   def do_rename(self, name):
     filename, _row, _col, offset, _offset_end = Buffers.location_at_cursor(self.view)
@@ -30,7 +177,8 @@ class GotoolsRenameCommand(sublime_plugin.TextCommand):
       "-to", name,
       "-v"
     ]
-    output, err, exit = ToolRunner.run_prepared(self.gorename, args, timeout=15)
+    # No coalescing key: gorename rewrites files and must never be killed midway.
+    output, err, exit = ToolRunner.run(self.view, 'gorename', args, timeout=15, feature='rename')
 
     if exit != 0:
       Logger.status("rename failed ({0}): {1}".format(exit, err))
@@ -47,3 +195,119 @@ class GotoolsRenameCommand(sublime_plugin.TextCommand):
     panel.run_command("right_delete")
     panel.run_command('append', {'characters': err})
     self.view.window().run_command("show_panel", {"panel": "output.gotools_rename"})
+
+  def do_rename_diff(self, name):
+    """Rename through `gorename -d`, editing open buffers in place and writing only unopened files.
+
+    Open buffers take the edits as one undoable change each and are left
+    unsaved; no view has to reload from disk. If any file or open buffer no
+    longer matches what gorename saw, nothing is renamed.
+    """
+    filename, _row, _col, offset, _offset_end = Buffers.location_at_cursor(self.view)
+    args = [
+      "-offset", "{file}:#{offset}".format(file=filename, offset=offset),
+      "-to", name,
+      "-d"
+    ]
+    output, err, exit = ToolRunner.run(self.view, 'gorename', args, timeout=15, feature='rename')
+
+    # diff exits non-zero when files differ, so gorename's status only counts
+    # when it printed no diff.
+    files = parse_unified_diff(output)
+    if exit != 0 and not files:
+      Logger.status("rename failed ({0}): {1}".format(exit, err))
+      return
+
+    # Nothing is changed until every file and open buffer is known to match
+    # what gorename saw; a partly applied rename wouldn't compile.
+    failed = []
+    in_files = []
+    in_views = []
+    for path, hunks in files:
+      edits, preview = diff_edits(hunks)
+      if not edits:
+        continue
+
+      view = self.find_open_view(path)
+      if view is not None:
+        in_views.append((path, view, edits, preview))
+        continue
+      try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+          text = apply_edits(f.read(), edits)
+      except (OSError, IOError) as e:
+        failed.append(path + ": " + str(e))
+        continue
+      if text is None:
+        failed.append(path + ": file changed during rename")
+        continue
+      in_files.append((path, text, preview))
+
+    renamed = {}
+    if not failed and in_views:
+      # Buffers are checked and edited in one go on the UI thread, where
+      # nothing can change them in between.
+      done = threading.Event()
+      def apply_in_views():
+        try:
+          for path, view, edits, preview in in_views:
+            if edit_regions(view, edits) is None:
+              failed.append(path + ": buffer differs from the file on disk")
+          if failed:
+            return
+          for path, view, edits, preview in in_views:
+            view.run_command('gotools_apply_edits', {'edits': edits})
+            renamed[path] = preview
+        finally:
+          done.set()
+      sublime.set_timeout(apply_in_views, 0)
+      done.wait()
+
+    if failed:
+      Logger.status("rename aborted; see the rename panel")
+      self.show_panel("Rename to {0} aborted; nothing was changed:\n".format(name) +
+                      "\n".join("\t" + f for f in failed) + "\n")
+      return
+
+    for path, text, preview in in_files:
+      try:
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+          f.write(text)
+      except (OSError, IOError) as e:
+        failed.append(path + ": " + str(e))
+        continue
+      renamed[path] = preview
+
+    report = []
+    lines = 0
+    for path, hunks in files:
+      preview = renamed.get(path)
+      if preview is None:
+        continue
+      lines += len(preview)
+      report.extend("{0}:{1}:{2}: {3}".format(path, row, col, line) for row, col, line in preview)
+
+    header = "Renamed symbol to {0}: {1} lines changed in {2} files".format(name, lines, len(renamed))
+    if failed:
+      header += "\nNot renamed:\n" + "\n".join("\t" + f for f in failed)
+      Logger.status("rename incomplete; see the rename panel")
+    else:
+      Logger.status("renamed symbol to {name}".format(name=name))
+
+    self.show_panel(header + "\n\n" + "\n".join(report) + "\n")
+
+  def show_panel(self, text):
+    panel = self.view.window().create_output_panel('gotools_rename')
+    panel.set_scratch(True)
+    panel.settings().set("result_file_regex", "^(.*\.go):(\d+):(\d+): (.*)$")
+    panel.run_command("select_all")
+    panel.run_command("right_delete")
+    panel.run_command('append', {'characters': text})
+    self.view.window().run_command("show_panel", {"panel": "output.gotools_rename"})
+
+  def find_open_view(self, path):
+    for window in sublime.windows():
+      view = window.find_open_file(path)
+      if view is not None:
+        return view
+    return None
@@ -0,0 +1,150 @@
+"""Starts tool processes on behalf of GoTools.
+
+Sublime Text's plugin host is a large process, and starting a tool from it
+costs more the more memory it holds. With the spawner_python setting,
+`gotools_util.Spawner` runs this script under that interpreter once per
+session and sends it every tool to start instead.
+
+Messages in both directions are JSON objects, each preceded by its length
+as a 4-byte big-endian integer. Byte strings are base64 encoded.
+
+    request:  {"id": n, "argv": [...], "env": {...}, "cwd": path or null,
+               "stdin": base64 or null, "timeout": seconds}
+              {"id": n, "kill": true}
+    response: {"id": n, "stdout": base64, "stderr": base64, "rc": status,
+               "timed_out": bool}
+              {"id": n, "error": message}
+
+The helper exits, killing whatever it started, once its stdin is closed.
+Sublime Text also loads this file as a plugin module, so it must not import
+sublime or do anything outside the main guard.
+"""
+
+import base64
+import json
+import platform
+import struct
+import subprocess
+import sys
+import threading
+
+HEADER = struct.Struct('>I')
+
+
+def read_message(stream):
+    """Read one framed message; None at the end of the stream."""
+    header = read_exactly(stream, HEADER.size)
+    if header is None:
+        return None
+    body = read_exactly(stream, HEADER.unpack(header)[0])
+    if body is None:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def write_message(stream, message):
+    body = json.dumps(message).encode('utf-8')
+    stream.write(HEADER.pack(len(body)) + body)
+    stream.flush()
+
+
+def encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+class Helper(object):
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        self.processes = {}
+        # Kill requests that arrived before their process started.
+        self.killed = set()
+
+    def serve(self):
+        while True:
+            message = read_message(self.stdin)
+            if message is None:
+                break
+            if message.get('kill'):
+                self.kill(message['id'])
+                continue
+            thread = threading.Thread(target=self.spawn, args=(message,))
+            thread.daemon = True
+            thread.start()
+
+        with self.lock:
+            processes = list(self.processes.values())
+        for p in processes:
+            self.kill_process(p)
+
+    def spawn(self, request):
+        ident = request['id']
+        si = None
+        if platform.system() == "Windows":
+            si = subprocess.STARTUPINFO()
+            si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+        try:
+            p = subprocess.Popen(request['argv'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, env=request.get('env'), cwd=request.get('cwd'),
+                                 startupinfo=si)
+        except (OSError, ValueError) as e:
+            self.reply({'id': ident, 'error': str(e)})
+            return
+
+        with self.lock:
+            self.processes[ident] = p
+            if ident in self.killed:
+                self.killed.discard(ident)
+                self.kill_process(p)
+
+        stdin = request.get('stdin')
+        if stdin is not None:
+            stdin = base64.b64decode(stdin)
+        timed_out = False
+        try:
+            stdout, stderr = p.communicate(input=stdin, timeout=request.get('timeout'))
+        except subprocess.TimeoutExpired:
+            self.kill_process(p)
+            stdout, stderr = p.communicate()
+            timed_out = True
+        finally:
+            with self.lock:
+                self.processes.pop(ident, None)
+
+        self.reply({'id': ident, 'stdout': encode(stdout), 'stderr': encode(stderr),
+                    'rc': p.returncode, 'timed_out': timed_out})
+
+    def kill(self, ident):
+        with self.lock:
+            p = self.processes.get(ident)
+            if p is None:
+                self.killed.add(ident)
+                return
+        self.kill_process(p)
+
+    def kill_process(self, p):
+        if p.poll() is None:
+            try:
+                p.kill()
+            except OSError:
+                pass
+
+    def reply(self, message):
+        with self.lock:
+            write_message(self.stdout, message)
+
+
+if __name__ == '__main__':
+    Helper(sys.stdin.buffer, sys.stdout.buffer).serve()
@@ -1,15 +1,23 @@
 import sublime
 import sublime_plugin
+import functools
+import hashlib
+import heapq
 import json
+import re
+
+from collections import OrderedDict
 
 from .gotools_util import Buffers
+from .gotools_util import GocodeSession
 from .gotools_util import GoBuffers
 from .gotools_util import Logger
-from .gotools_util import ToolRunner
 
 import golangconfig
 
 
+FUNC_TYPE_TOKEN_RE = re.compile(r'[(),]')
+
 def _lex_func_type(typ):
   """Convert a function type into list of arguments and return value names"""
   args = []
@@ -18,31 +26,118 @@ def _lex_func_type(typ):
   current = args
   parens_depth = 0
 
-  val = ''
-  for char in typ[4:].strip():
+  # Text between parentheses and commas is collected in pieces rather than a
+  # character at a time.
+  text = typ[4:].strip()
+  val = []
+  last = 0
+  for token in FUNC_TYPE_TOKEN_RE.finditer(text):
+    val.append(text[last:token.start()])
+    last = token.end()
+    char = token.group(0)
     if char == '(':
       if parens_depth != 0:
-        val += '('
+        val.append('(')
 
       parens_depth += 1
     elif char == ')':
       parens_depth -= 1
       if parens_depth != 0:
-        val += ')'
+        val.append(')')
 
       if parens_depth == 0:
-        current.append(val.strip())
-        val = ''
+        current.append(''.join(val).strip())
+        val = []
         current = returns
-    elif char == ',':
-      if parens_depth == 1:
-        current.append(val.strip())
-        val = ''
-    else:
-      val += char
+    elif parens_depth == 1:
+      current.append(''.join(val).strip())
+      val = []
 
   return args, returns
 
+@functools.lru_cache(maxsize=4096)
+def _compile_signature(typ):
+  """The argument snippet for a function type, e.g. '(${1:ctx}, ${2:name})'.
+
+  Packages share few distinct signatures across many names, so compiled
+  snippets are memoized by type string.
+  """
+  args, _ = _lex_func_type(typ)
+  snippets = ["${{{0}:{1}}}".format(n + 1, arg.split(' ', 1)[0]) for n, arg in enumerate(args)]
+  return '(' + ', '.join(snippets) + ')'
+
+def rank_candidates(candidates, prefix, limit=0):
+  """Order candidates by how well their names match prefix, best first.
+
+  Names starting with prefix come first, then names starting with it in
+  another case, then names containing its characters in order, the ones
+  with the tightest match first. Other names are dropped. Ties keep gocode's
+  order. With a limit, only the best `limit` candidates are returned.
+  """
+  if not prefix:
+    return candidates[:limit] if limit else list(candidates)
+
+  lower = prefix.lower()
+  fuzzy = re.compile('.*?'.join(re.escape(c) for c in lower))
+  ranked = []
+  exact = 0
+  for index, candidate in enumerate(candidates):
+    name = candidate["name"]
+    if name.startswith(prefix):
+      ranked.append((0, 0, index, candidate))
+      exact += 1
+      if exact == limit:
+        # Nothing later can beat these.
+        break
+      continue
+    folded = name.lower()
+    if folded.startswith(lower):
+      ranked.append((1, 0, index, candidate))
+      continue
+    match = fuzzy.search(folded)
+    if match:
+      ranked.append((2, match.end() - match.start(), index, candidate))
+
+  key = lambda r: r[:3]
+  ranked = heapq.nsmallest(limit, ranked, key=key) if limit else sorted(ranked, key=key)
+  return [r[3] for r in ranked]
+
+class CompletionCache():
+  """LRU of gocode candidates for the identifier currently being typed.
+
+  Entries are keyed by the file, the offset where the identifier starts and
+  digests of the buffer before and after it, so extending the identifier
+  keeps hitting the same entry while any edit outside of it misses. Each
+  file holds at most one entry; storing a new one drops the stale one.
+  """
+
+  def __init__(self, size=32):
+    self.size = size
+    self.entries = OrderedDict()
+
+  @staticmethod
+  def key(view, word_start, cursor):
+    data = Buffers.buffer_text(view)
+    before = hashlib.sha1(data[:Buffers.offset_at_point(view, word_start)]).hexdigest()
+    after = hashlib.sha1(data[Buffers.offset_at_point(view, cursor):]).hexdigest()
+    return (view.file_name() or view.buffer_id(), word_start, before, after)
+
+  def get(self, key):
+    candidates = self.entries.get(key)
+    if candidates is not None:
+      self.entries.move_to_end(key)
+    return candidates
+
+  def put(self, key, candidates):
+    for stale in [k for k in self.entries if k[0] == key[0]]:
+      del self.entries[stale]
+    self.entries[key] = candidates
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+# Views whose next completion request skips completion_limit.
+_show_all = set()
+
 class GotoolsSuggestions(sublime_plugin.EventListener):
   @classmethod
   def is_applicable(cls, settings):
@@ -55,23 +150,57 @@ class GotoolsSuggestions(sublime_plugin.EventListener):
     "package": "ρ"
   }
 
+  def __init__(self):
+    self.cache = CompletionCache()
+
   def on_query_completions(self, view, prefix, locations):
     if not self.is_applicable(view.settings()):
         return
 
-    suggestions_json_str, stderr, rc = ToolRunner.run(view, "gocode", ["-f=json", "autocomplete", 
-      str(Buffers.offset_at_cursor(view)[0])], stdin=Buffers.buffer_text(view))
+    # Ask gocode for everything completable at the start of the identifier
+    # and narrow by prefix here, so further keystrokes in the same word are
+    # answered from the cache.
+    word_start = locations[0] - len(prefix)
+    key = CompletionCache.key(view, word_start, locations[0])
+    candidates = self.cache.get(key)
+    if candidates is None:
+      candidates = self.query_gocode(view, word_start)
+      if candidates is None:
+        return []
+      self.cache.put(key, candidates)
+
+    # Only the best matches go back to Sublime, so that huge packages don't
+    # stall the popup; GotoolsShowAllCompletions asks for the rest.
+    limit = golangconfig.setting_value('completion_limit', view=view)[0] or 0
+    if view.id() in _show_all:
+      _show_all.discard(view.id())
+      limit = 0
+    matches = rank_candidates(candidates, prefix, limit + 1 if limit else 0)
+    if len(matches) == 0:
+      return []
 
-    suggestions_json = json.loads(suggestions_json_str)
+    flags = sublime.INHIBIT_WORD_COMPLETIONS
+    if limit and len(matches) > limit:
+      matches = matches[:limit]
+      # Sublime only filters what it was given; ask it to come back as the
+      # prefix grows so the truncated part isn't lost.
+      flags |= getattr(sublime, 'DYNAMIC_COMPLETIONS', 0)
+    return (GotoolsSuggestions.build_suggestions(matches), flags)
+
+  def query_gocode(self, view, point):
+    offset = Buffers.offset_at_point(view, point)
+    suggestions_json_str, stderr, rc = GocodeSession.run(view, ["-f=json", "autocomplete",
+      str(offset)], stdin=Buffers.buffer_text(view), feature='completion', key=(view.id(), 'completion'))
 
     Logger.log("DEBUG: gocode output: " + suggestions_json_str)
 
     if rc != 0:
-      Logger.status("no completions found: " + str(e))
-      return []
-    
+      Logger.status("no completions found: " + stderr)
+      return None
+
+    suggestions_json = json.loads(suggestions_json_str)
     if len(suggestions_json) > 0:
-      return ([GotoolsSuggestions.build_suggestion(j) for j in suggestions_json[1]], sublime.INHIBIT_WORD_COMPLETIONS)
+      return suggestions_json[1]
     else:
       return []
 
@@ -79,12 +208,26 @@ class GotoolsSuggestions(sublime_plugin.EventListener):
   def build_suggestion(json):
     completion = json["name"]
     if json["class"] == 'func':
-      args, _ = _lex_func_type(json["type"])
-      snippets = ["${{{0}:{1}}}".format(n + 1, arg.split(' ', 1)[0]) for n, arg in enumerate(args)]
-      completion += '(' + ', '.join(snippets) + ')'
+      completion += _compile_signature(json["type"])
 
     label = '{0: <30.30} {1: <40.40} {2}'.format(
       json["name"],
       json["type"],
       GotoolsSuggestions.CLASS_SYMBOLS.get(json["class"], "?"))
     return (label, completion)
+
+  @staticmethod
+  def build_suggestions(candidates):
+    build = GotoolsSuggestions.build_suggestion
+    return [build(j) for j in candidates]
+
+class GotoolsShowAllCompletions(sublime_plugin.TextCommand):
+  """Reopen the completion popup without the completion_limit cut-off."""
+
+  def is_enabled(self):
+    return GoBuffers.is_go_source(self.view)
+
+  def run(self, edit):
+    _show_all.add(self.view.id())
+    self.view.run_command('hide_auto_complete')
+    self.view.run_command('auto_complete', {'disable_auto_insert': True, 'next_completion_if_showing': False})
@@ -1,9 +1,94 @@
 import sublime
 import sublime_plugin
 import json
+import re
+import threading
+import time
 
 from .gotools_util import Buffers
-from .gotools_util import ToolRunner
+from .gotools_util import GocodeSession
+from .gotools_util import Scheduler
+from .gotools_index import SymbolIndex
+
+import golangconfig
+
+IDENT_RE = re.compile(r'\b[A-Za-z_]\w*\b')
+
+GO_KEYWORDS = frozenset([
+  'break', 'case', 'chan', 'const', 'continue', 'default', 'defer', 'else',
+  'fallthrough', 'for', 'func', 'go', 'goto', 'if', 'import', 'interface',
+  'map', 'package', 'range', 'return', 'select', 'struct', 'switch', 'type',
+  'var', '_',
+])
+
+
+class PrefetchCache():
+  """Types and definitions already resolved for identifiers in a view.
+
+  Entries are keyed by the identifier's region and belong to the change
+  count they were resolved at; the first lookup after an edit drops them.
+  """
+
+  _views = {}
+  _lock = threading.Lock()
+
+  @staticmethod
+  def _entry(view):
+    entry = PrefetchCache._views.get(view.id())
+    if entry is None or entry[0] != view.change_count():
+      entry = (view.change_count(), {}, {})
+      PrefetchCache._views[view.id()] = entry
+    return entry
+
+  @staticmethod
+  def get_type(view, region):
+    with PrefetchCache._lock:
+      return PrefetchCache._entry(view)[1].get((region.a, region.b))
+
+  @staticmethod
+  def put_type(view, region, change_count, typ):
+    with PrefetchCache._lock:
+      entry = PrefetchCache._entry(view)
+      if entry[0] == change_count:
+        entry[1][(region.a, region.b)] = typ
+
+  @staticmethod
+  def get_definition(view, region):
+    with PrefetchCache._lock:
+      return PrefetchCache._entry(view)[2].get((region.a, region.b))
+
+  @staticmethod
+  def put_definition(view, region, change_count, location):
+    with PrefetchCache._lock:
+      entry = PrefetchCache._entry(view)
+      if entry[0] == change_count:
+        entry[2][(region.a, region.b)] = location
+
+  @staticmethod
+  def discard(view):
+    with PrefetchCache._lock:
+      PrefetchCache._views.pop(view.id(), None)
+
+
+def gocode_type(view, region, feature, key):
+  """Ask gocode for the type of the identifier in region; '' if it has none, None on failure."""
+  end = Buffers.offset_at_point(view, region.end())
+  args = ["-f=json", "autocomplete", str(end)]
+  stdin = Buffers.buffer_text(view)
+  # Not kept in the DiskCache: gocode checks the buffer against the compiled
+  # archives of its imports, which no digest of the buffer covers.
+  suggestions_json_str, stderr, rc = GocodeSession.run(view, args, stdin=stdin, feature=feature, key=key)
+  if rc != 0:
+    return None
+
+  parts = json.loads(suggestions_json_str)
+  typ = ''
+  if parts and parts[1]:
+    name = view.substr(region)
+    exact = [p for p in parts[1] if p['name'] == name]
+    if exact:
+      typ = exact[0]["type"]
+  return typ
 
 
 class GotoolsShowTypeCommand(sublime_plugin.ViewEventListener):
@@ -16,24 +101,123 @@ class GotoolsShowTypeCommand(sublime_plugin.ViewEventListener):
     self.view = view
     self.phantom_set = sublime.PhantomSet(view)
 
-    self.gocode = ToolRunner.prepare(view, 'gocode')
+    self.last_activity = time.time()
+    self.prefetch_scheduled = False
+    self.prefetching = False
+
+  # Activity is noted on the UI thread too, as it happens: the async
+  # callbacks below queue up behind whatever else runs on the async thread.
+  def on_selection_modified(self):
+    self.note_activity()
+
+  def on_modified(self):
+    self.note_activity()
 
   def on_selection_modified_async(self):
-    start, end = Buffers.symbol_offset_at_cursor(self.view)
-    if end == self.offset:
-      return
-    self.offset = end
+    self.touch()
 
-    suggestions_json_str, stderr, rc = ToolRunner.run_prepared(self.gocode, ["-f=json", "autocomplete", 
-      str(end)], stdin=Buffers.buffer_text(self.view))
+    word = self.view.word(self.view.sel()[0])
+    if word.end() == self.offset:
+      return
+    self.offset = word.end()
 
-    parts = json.loads(suggestions_json_str)
-    typ = ''
-    if parts and parts[1]:
-      name = self.view.substr(self.view.word(self.view.sel()[0]))
-      exact = [p for p in parts[1] if p['name'] == name]
-      if exact:
-        typ = exact[0]["type"]
+    change_count = self.view.change_count()
+    typ = PrefetchCache.get_type(self.view, word)
+    if typ is None:
+      typ = gocode_type(self.view, word, 'show_type', (self.view.id(), 'show_type'))
+      if typ is None:
+        return
+      PrefetchCache.put_type(self.view, word, change_count, typ)
 
-    phantoms = [sublime.Phantom(sublime.Region(start, start), typ, sublime.LAYOUT_BELOW)] if typ else []
+    phantoms = [sublime.Phantom(sublime.Region(word.begin(), word.begin()), typ, sublime.LAYOUT_BELOW)] if typ else []
     self.phantom_set.update(phantoms)
+
+  def on_modified_async(self):
+    self.touch()
+
+  def on_activated_async(self):
+    self.touch()
+
+  def on_close(self):
+    PrefetchCache.discard(self.view)
+
+  def note_activity(self):
+    """Stop a running prefetch pass, killing its gocode query."""
+    self.last_activity = time.time()
+    if self.prefetching:
+      Scheduler.cancel((self.view.id(), 'prefetch'))
+
+  def touch(self):
+    """Note editor activity and arrange for a prefetch once the view goes idle."""
+    self.last_activity = time.time()
+    idle_ms = golangconfig.setting_value('prefetch_idle_ms', view=self.view)[0]
+    if not idle_ms or self.prefetch_scheduled:
+      return
+    self.prefetch_scheduled = True
+    sublime.set_timeout_async(self.prefetch_if_idle, idle_ms)
+
+  def prefetch_if_idle(self):
+    idle_ms = golangconfig.setting_value('prefetch_idle_ms', view=self.view)[0] or 0
+    remaining = idle_ms - (time.time() - self.last_activity) * 1000
+    if remaining > 0:
+      sublime.set_timeout_async(self.prefetch_if_idle, int(remaining) + 1)
+      return
+    self.prefetch_scheduled = False
+    if self.prefetching:
+      return
+    # The pass gets its own thread so that show-type and goto-def, which run
+    # on the async thread, never wait behind it.
+    self.prefetching = True
+    threading.Thread(target=self.prefetch, daemon=True).start()
+
+  def prefetch(self):
+    """Resolve types and definitions of the visible identifiers, nearest to the cursor first.
+
+    Stops at the first sign of activity, or once prefetch_max_processes tools
+    have run or prefetch_budget_ms has passed.
+    """
+    try:
+      self._prefetch()
+    finally:
+      self.prefetching = False
+
+  def _prefetch(self):
+    max_processes = golangconfig.setting_value('prefetch_max_processes', view=self.view)[0] or 0
+    budget_ms = golangconfig.setting_value('prefetch_budget_ms', view=self.view)[0] or 0
+    use_index = golangconfig.setting_value('symbol_index', view=self.view)[0] is not False
+    started = time.time()
+    activity = self.last_activity
+    change_count = self.view.change_count()
+
+    visible = self.view.visible_region()
+    text = self.view.substr(visible)
+    cursor = self.view.sel()[0].begin() if len(self.view.sel()) > 0 else visible.begin()
+    regions = []
+    for match in IDENT_RE.finditer(text):
+      if match.group(0) in GO_KEYWORDS:
+        continue
+      region = sublime.Region(visible.begin() + match.start(), visible.begin() + match.end())
+      if self.view.match_selector(region.begin(), 'comment, string'):
+        continue
+      regions.append(region)
+    regions.sort(key=lambda r: abs(r.begin() - cursor))
+
+    processes = 0
+    for region in regions:
+      if self.last_activity != activity or self.view.change_count() != change_count:
+        return
+      if (time.time() - started) * 1000 > budget_ms:
+        return
+
+      if use_index and PrefetchCache.get_definition(self.view, region) is None:
+        location = SymbolIndex.resolve(self.view, region.begin())
+        if location:
+          PrefetchCache.put_definition(self.view, region, change_count, location)
+
+      if PrefetchCache.get_type(self.view, region) is None:
+        if processes >= max_processes:
+          return
+        processes += 1
+        typ = gocode_type(self.view, region, 'prefetch', (self.view.id(), 'prefetch'))
+        if typ is not None:
+          PrefetchCache.put_type(self.view, region, change_count, typ)
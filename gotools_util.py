@@ -1,41 +1,244 @@
 import sublime
+import sublime_plugin
+import base64
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
 import platform
+import queue
+import socket
+import struct
 import subprocess
+import threading
 import time
 
+from .gotools_spawner import read_message
+from .gotools_spawner import write_message
+
 import golangconfig
 
 
+class OffsetIndex():
+  """Line start offsets of a buffer, in characters and in UTF-8 bytes.
+
+  gocode, godef and friends address the buffer by byte offset while Sublime
+  works in characters. Rather than encoding the whole prefix of the buffer
+  for every conversion, the index remembers where each line starts in both
+  units and only encodes the partial line in front of a point.
+
+  Rows are filled in lazily, in chunks, up to the furthest row asked for.
+  Edits truncate the table at the first changed row (on Sublime Text 4,
+  through `GotoolsOffsetTracker`); if the view's change count moved on
+  without the index hearing about it, it starts again from the top.
+  """
+
+  CHUNK = 1 << 16
+
+  _indexes = {}
+  _lock = threading.Lock()
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset(-1)
+
+  @staticmethod
+  def for_view(view):
+    with OffsetIndex._lock:
+      index = OffsetIndex._indexes.get(view.buffer_id())
+      if index is None:
+        index = OffsetIndex()
+        OffsetIndex._indexes[view.buffer_id()] = index
+      return index
+
+  @staticmethod
+  def discard(view):
+    with OffsetIndex._lock:
+      OffsetIndex._indexes.pop(view.buffer_id(), None)
+
+  def reset(self, change_count):
+    self.change_count = change_count
+    self.char_starts = [0]
+    self.byte_starts = [0]
+    self.complete = False
+
+  def truncate(self, row, change_count):
+    with self.lock:
+      if row + 1 < len(self.char_starts):
+        del self.char_starts[row + 1:]
+        del self.byte_starts[row + 1:]
+      self.complete = False
+      self.change_count = change_count
+
+  def offset_at_point(self, view, point):
+    with self.lock:
+      self._sync(view)
+      while not self.complete and self.char_starts[-1] <= point:
+        self._extend(view)
+      row = bisect.bisect_right(self.char_starts, point) - 1
+      return self._offset(view, row, point)
+
+  def offset_at_row_col(self, view, row, col):
+    with self.lock:
+      self._sync(view)
+      while not self.complete and len(self.char_starts) <= row:
+        self._extend(view)
+      row = min(row, len(self.char_starts) - 1)
+      return self._offset(view, row, view.text_point(row, col))
+
+  def _offset(self, view, row, point):
+    line_start = self.char_starts[row]
+    if point <= line_start:
+      return self.byte_starts[row]
+    return self.byte_starts[row] + len(view.substr(sublime.Region(line_start, point)).encode('utf-8'))
+
+  def _sync(self, view):
+    if self.change_count != view.change_count():
+      self.reset(view.change_count())
+
+  def _extend(self, view):
+    size = view.size()
+    start = self.char_starts[-1]
+    chunk = OffsetIndex.CHUNK
+    while True:
+      end = min(size, start + chunk)
+      # The last piece is either unterminated or cut off by the chunk.
+      lines = view.substr(sublime.Region(start, end)).split('\n')[:-1]
+      if end == size:
+        self.complete = True
+      elif not lines:
+        # A single line longer than the chunk; read further.
+        chunk *= 2
+        continue
+      break
+
+    char_start = start
+    byte_start = self.byte_starts[-1]
+    for line in lines:
+      char_start += len(line) + 1
+      byte_start += len(line.encode('utf-8')) + 1
+      self.char_starts.append(char_start)
+      self.byte_starts.append(byte_start)
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+  class GotoolsOffsetTracker(sublime_plugin.TextChangeListener):
+    """Truncates a buffer's offset index at the first row an edit touched."""
+
+    @classmethod
+    def is_applicable(cls, buffer):
+      view = buffer.primary_view()
+      return view is not None and view.score_selector(0, 'source.go') != 0
+
+    def on_text_changed(self, changes):
+      view = self.buffer.primary_view()
+      if view is None or not changes:
+        return
+      # Each change's rows are as of just before it, so no row above the
+      # smallest of them moved. This runs on the UI thread, where edits are
+      # made, and is handed every change up to now, so the table is valid
+      # for the view's current change count.
+      row = min(change.a.row for change in changes)
+      OffsetIndex.for_view(view).truncate(row, view.change_count())
+
+    def on_reload(self):
+      self.forget()
+
+    def on_revert(self):
+      self.forget()
+
+    def forget(self):
+      view = self.buffer.primary_view()
+      if view is not None:
+        OffsetIndex.discard(view)
+
+Snapshot = collections.namedtuple('Snapshot', ['change_count', 'data', 'digest'])
+
+class Snapshots():
+  """UTF-8 encoded buffer contents shared by every feature, one per buffer.
+
+  A snapshot is reused for as long as the view's change count hasn't moved,
+  so completion, show-type and format running against the same unchanged
+  buffer encode it once between them. The cache is bounded by total size,
+  dropping the least recently used buffers first, and forgets a buffer when
+  its view closes.
+  """
+
+  MAX_BYTES = 64 * 1024 * 1024
+
+  _entries = collections.OrderedDict()
+  _size = 0
+  _lock = threading.Lock()
+
+  @staticmethod
+  def get(view):
+    key = view.buffer_id()
+    change_count = view.change_count()
+    with Snapshots._lock:
+      snapshot = Snapshots._entries.get(key)
+      if snapshot is not None and snapshot.change_count == change_count:
+        Snapshots._entries.move_to_end(key)
+        return snapshot
+
+    data = view.substr(sublime.Region(0, view.size())).encode('utf-8')
+    snapshot = Snapshot(change_count, data, hashlib.sha1(data).hexdigest())
+    if view.change_count() != change_count:
+      # Edited while we were reading; don't cache a mislabelled snapshot.
+      return snapshot
+
+    with Snapshots._lock:
+      Snapshots._remove(key)
+      Snapshots._entries[key] = snapshot
+      Snapshots._size += len(data)
+      while Snapshots._size > Snapshots.MAX_BYTES and len(Snapshots._entries) > 1:
+        Snapshots._remove(next(iter(Snapshots._entries)))
+    return snapshot
+
+  @staticmethod
+  def discard(view):
+    with Snapshots._lock:
+      Snapshots._remove(view.buffer_id())
+
+  @staticmethod
+  def _remove(key):
+    snapshot = Snapshots._entries.pop(key, None)
+    if snapshot is not None:
+      Snapshots._size -= len(snapshot.data)
+
+class GotoolsBufferCacheListener(sublime_plugin.EventListener):
+  def on_close(self, view):
+    OffsetIndex.discard(view)
+    Snapshots.discard(view)
+
 class Buffers():
   @staticmethod
   def offset_at_row_col(view, row, col):
-    point = view.text_point(row, col)
-    select_region = sublime.Region(0, point)
-    string_region = view.substr(select_region)
-    buffer_region = bytearray(string_region, encoding="utf8")
-    offset = len(buffer_region)
-    return offset
+    return OffsetIndex.for_view(view).offset_at_row_col(view, row, col)
+
+  @staticmethod
+  def offset_at_point(view, point):
+    return OffsetIndex.for_view(view).offset_at_point(view, point)
 
   @staticmethod
   def buffer_text(view):
-    file_text = sublime.Region(0, view.size())
-    return view.substr(file_text).encode('utf-8')
+    return Snapshots.get(view).data
 
   @staticmethod
-  def offset_at_cursor(view):
-    begin_row, begin_col = view.rowcol(view.sel()[0].begin())
-    end_row, end_col = view.rowcol(view.sel()[0].end())
+  def buffer_digest(view):
+    return Snapshots.get(view).digest
 
-    return (Buffers.offset_at_row_col(view, begin_row, begin_col), Buffers.offset_at_row_col(view, end_row, end_col))
+  @staticmethod
+  def offset_at_cursor(view):
+    sel = view.sel()[0]
+    return (Buffers.offset_at_point(view, sel.begin()), Buffers.offset_at_point(view, sel.end()))
 
   @staticmethod
   def symbol_offset_at_cursor(view):
-    start_position = view.rowcol(view.word(view.sel()[0]).begin())
-    end_position = view.rowcol(view.word(view.sel()[0]).end())
-
-    return Buffers.offset_at_row_col(view, *start_position), Buffers.offset_at_row_col(view, *end_position)
+    word = view.word(view.sel()[0])
+    return Buffers.offset_at_point(view, word.begin()), Buffers.offset_at_point(view, word.end())
 
   @staticmethod
   def location_at_cursor(view):
@@ -47,17 +250,18 @@ class Buffers():
   def location_for_event(view, event):
     pt = view.window_to_text((event["x"], event["y"]))
     row, col = view.rowcol(pt)
-    offset = Buffers.offset_at_row_col(view, row, col)
+    offset = Buffers.offset_at_point(view, pt)
     return (view.file_name(), row, col, offset)
 
 class GoBuffers():
   @staticmethod
   def func_name_at_cursor(view):
     func_regions = view.find_by_selector('meta.function')
+    cursor = view.sel()[0].begin()
 
     func_name = ""
     for r in func_regions:
-      if r.contains(Buffers.offset_at_cursor(view)[0]):
+      if r.contains(cursor):
         lines = view.substr(r).splitlines()
         match = re.match('func.*(Test.+)\(', lines[0])
         if match and match.group(1):
@@ -70,6 +274,259 @@ class GoBuffers():
   def is_go_source(view):
     return view.score_selector(0, 'source.go') != 0
 
+class Packages():
+  @staticmethod
+  def fingerprint(path, content=False):
+    """Digest of the names, sizes and mtimes of the .go files in a package directory.
+
+    With content set, the digest also covers the files' contents. Returns
+    None if the directory can't be read.
+    """
+    try:
+      names = sorted(os.listdir(path))
+    except OSError:
+      return None
+
+    digest = hashlib.sha1()
+    for name in names:
+      if not name.endswith('.go'):
+        continue
+      file_path = os.path.join(path, name)
+      try:
+        st = os.stat(file_path)
+        digest.update("{0}\0{1}\0{2}\n".format(name, st.st_size, st.st_mtime_ns).encode('utf-8'))
+        if content:
+          with open(file_path, 'rb') as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+      except OSError:
+        continue
+    return digest.hexdigest()
+
+  @staticmethod
+  def fingerprint_tree(paths, content=False):
+    """Combined fingerprint of every package directory below the given paths."""
+    digest = hashlib.sha1()
+    for root in sorted(set(paths)):
+      for path, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')) and d != 'testdata')
+        if not any(f.endswith('.go') for f in files):
+          continue
+        digest.update("{0}\0{1}\n".format(path, Packages.fingerprint(path, content)).encode('utf-8'))
+    return digest.hexdigest()
+
+  @staticmethod
+  def source_fingerprint(view, tool, filename, package_scope):
+    """Fingerprint the Go sources a tool run on filename over package_scope reads.
+
+    Covers the file's own package and either the whole project package or,
+    without one, the packages in the scope, as found on the tool's GOPATH.
+    """
+    gopath = ToolRunner.prepare(view, tool)[1].get('GOPATH', '')
+    roots = [os.path.dirname(filename)]
+    project_pkg = golangconfig.setting_value('project_package', view=view)[0]
+    project_dir = Packages.dir_for_import(project_pkg, gopath) if project_pkg else None
+    if project_dir:
+      roots.append(project_dir)
+    else:
+      roots.extend(d for d in (Packages.dir_for_import(p, gopath) for p in package_scope) if d)
+    return Packages.fingerprint_tree(roots)
+
+  @staticmethod
+  def configured_scope(view=None):
+    """Import paths of every package configured for builds and tests of the project."""
+    project_pkg = golangconfig.setting_value('project_package', view=view)[0] or ""
+    scope = []
+    for setting in ['build_packages', 'test_packages', 'tagged_test_packages']:
+      for p in golangconfig.setting_value(setting, view=view)[0] or []:
+        if p:
+          scope.append(project_pkg + '/' + p if project_pkg else p)
+    return scope
+
+  @staticmethod
+  def dir_for_import(import_path, gopath):
+    """Find the source directory of an import path on a GOPATH, or None."""
+    for entry in gopath.split(os.pathsep):
+      if not entry:
+        continue
+      path = os.path.join(entry, 'src', *import_path.split('/'))
+      if os.path.isdir(path):
+        return path
+    return None
+
+class PackageGraph():
+  """The import graph of a project's packages, from `go list -json`.
+
+  The graph is loaded once per GOPATH and project package. Saving a .go file
+  marks its directory stale, and the next lookup re-lists only the stale
+  directories. It is used to cut oracle's analysis scope down to the
+  packages a query can actually involve.
+  """
+
+  # Modes whose answer only depends on the package under the cursor.
+  LOCAL_MODES = ('definition', 'describe', 'freevars', 'what')
+  # Modes whose answer can only involve packages importing the cursor's.
+  DEPENDENT_MODES = ('referrers', 'callers', 'callees', 'callstack', 'peers', 'pointsto')
+
+  _graphs = {}
+  _lock = threading.Lock()
+
+  def __init__(self, prepared, project_pkg):
+    self.prepared = prepared
+    self.project_pkg = project_pkg
+    self.lock = threading.Lock()
+    self.loaded = False
+    self.packages = {}
+    self.dirs = {}
+    self.importers = None
+    self.stale = set()
+
+  @staticmethod
+  def for_view(view):
+    project_pkg = golangconfig.setting_value('project_package', view=view)[0]
+    if not project_pkg:
+      return None
+    prepared = ToolRunner.prepare(view, 'go')
+    key = (prepared[1].get('GOPATH', ''), project_pkg)
+    with PackageGraph._lock:
+      graph = PackageGraph._graphs.get(key)
+      if graph is None:
+        graph = PackageGraph(prepared, project_pkg)
+        PackageGraph._graphs[key] = graph
+      return graph
+
+  @staticmethod
+  def invalidate_dir(path):
+    with PackageGraph._lock:
+      graphs = list(PackageGraph._graphs.values())
+    for graph in graphs:
+      with graph.lock:
+        graph.stale.add(path)
+
+  @staticmethod
+  def minimal_scope(view, mode, filename, configured):
+    """Narrow the configured oracle scope to what a query in mode at filename needs."""
+    if mode not in PackageGraph.LOCAL_MODES and mode not in PackageGraph.DEPENDENT_MODES:
+      return configured
+    graph = PackageGraph.for_view(view)
+    if graph is None:
+      return configured
+    package = graph.package_for_dir(os.path.dirname(filename))
+    if package is None:
+      return configured
+    if mode in PackageGraph.LOCAL_MODES:
+      return [package]
+    expanded = graph.expand(configured)
+    if expanded is None:
+      # Narrowing would silently drop what the graph doesn't know about.
+      return configured
+    importers = graph.reverse_dependencies(package)
+    return [package] + [p for p in expanded if p != package and p in importers]
+
+  def expand(self, patterns):
+    """The listed packages matching import paths and `/...` patterns, in order.
+
+    None if any of them matches no listed package.
+    """
+    self.refresh()
+    with self.lock:
+      packages = sorted(self.packages)
+    known = set(packages)
+    expanded = []
+    seen = set()
+    for pattern in patterns:
+      if pattern.endswith('/...'):
+        prefix = pattern[:-len('/...')]
+        matches = [p for p in packages if p == prefix or p.startswith(prefix + '/')]
+      else:
+        matches = [pattern] if pattern in known else []
+      if not matches:
+        Logger.log("oracle scope entry {0} isn't in the package graph; using the configured scope".format(pattern))
+        return None
+      for p in matches:
+        if p not in seen:
+          seen.add(p)
+          expanded.append(p)
+    return expanded
+
+  def package_for_dir(self, path):
+    self.refresh()
+    with self.lock:
+      return self.dirs.get(path)
+
+  def reverse_dependencies(self, package):
+    """All packages that import package, directly or transitively."""
+    self.refresh()
+    with self.lock:
+      if self.importers is None:
+        self.importers = {}
+        for path, imports in self.packages.items():
+          for imported in imports[1]:
+            self.importers.setdefault(imported, set()).add(path)
+
+      seen = set()
+      pending = [package]
+      while pending:
+        for importer in self.importers.get(pending.pop(), ()):
+          if importer not in seen:
+            seen.add(importer)
+            pending.append(importer)
+      return seen
+
+  def refresh(self):
+    with self.lock:
+      if not self.loaded:
+        self.loaded = True
+        self.stale.clear()
+        self._list([self.project_pkg + '/...'], None)
+        return
+      stale = list(self.stale)
+      self.stale.clear()
+    for path in stale:
+      with self.lock:
+        self._list(['.'], path)
+
+  def _list(self, patterns, cwd):
+    if cwd is not None and not os.path.isdir(cwd):
+      self._forget_dir(cwd)
+      return
+    stdout, stderr, rc = ToolRunner.run_prepared(self.prepared, ['list', '-e', '-json'] + patterns,
+      timeout=60, cwd=cwd)
+    if rc != 0 and not stdout:
+      Logger.log("go list failed ({0}): {1}".format(rc, stderr))
+      return
+
+    if cwd is not None:
+      self._forget_dir(cwd)
+    decoder = json.JSONDecoder()
+    pos = 0
+    while True:
+      while pos < len(stdout) and stdout[pos].isspace():
+        pos += 1
+      if pos >= len(stdout):
+        break
+      try:
+        info, pos = decoder.raw_decode(stdout, pos)
+      except ValueError as e:
+        Logger.log("unable to parse go list output: " + str(e))
+        break
+      if info.get('ImportPath') and info.get('Dir'):
+        imports = set(info.get('Imports', [])) | set(info.get('TestImports', [])) | set(info.get('XTestImports', []))
+        self.packages[info['ImportPath']] = (info['Dir'], imports)
+        self.dirs[info['Dir']] = info['ImportPath']
+    self.importers = None
+
+  def _forget_dir(self, path):
+    package = self.dirs.pop(path, None)
+    if package is not None:
+      self.packages.pop(package, None)
+    self.importers = None
+
+class GotoolsPackageGraphListener(sublime_plugin.EventListener):
+  def on_post_save_async(self, view):
+    file_name = view.file_name()
+    if file_name and file_name.endswith('.go'):
+      PackageGraph.invalidate_dir(os.path.dirname(file_name))
+
 class Logger():
   @staticmethod
   def log(msg):
@@ -85,25 +542,683 @@ class Logger():
   def status(msg):
     sublime.status_message("GoTools: " + msg)
 
+class Metrics():
+  """Spawn counts, latencies, failures and I/O volume per tool and feature.
+
+  Latency percentiles come from the most recent SAMPLES runs of each tool
+  and feature. With the metrics_jsonl_path setting, every run is also
+  appended to that file as one JSON object per line.
+  """
+
+  SAMPLES = 1000
+  PERCENTILES = (50, 95, 99)
+
+  _stats = {}
+  _lock = threading.Lock()
+
+  @staticmethod
+  def record(toolpath, feature, elapsed_ms, rc, stdin, stdout, timed_out=False):
+    tool = os.path.basename(toolpath)
+    feature = feature or 'other'
+    stdin_bytes = len(stdin) if stdin else 0
+    stdout_bytes = len(stdout) if stdout else 0
+    with Metrics._lock:
+      stats = Metrics._stats.get((tool, feature))
+      if stats is None:
+        stats = {
+          'spawns': 0, 'timeouts': 0, 'failures': 0, 'cancelled': 0,
+          'stdin_bytes': 0, 'stdout_bytes': 0,
+          'latencies': collections.deque(maxlen=Metrics.SAMPLES),
+        }
+        Metrics._stats[(tool, feature)] = stats
+      stats['spawns'] += 1
+      stats['stdin_bytes'] += stdin_bytes
+      stats['stdout_bytes'] += stdout_bytes
+      stats['latencies'].append(elapsed_ms)
+      if timed_out:
+        stats['timeouts'] += 1
+      elif rc == ToolRunner.CANCELLED:
+        stats['cancelled'] += 1
+      elif rc != 0:
+        stats['failures'] += 1
+
+    path = golangconfig.setting_value('metrics_jsonl_path')[0]
+    if path:
+      record = {
+        'time': time.time(), 'tool': tool, 'feature': feature, 'ms': round(elapsed_ms, 3),
+        'rc': rc, 'timed_out': timed_out, 'stdin_bytes': stdin_bytes, 'stdout_bytes': stdout_bytes,
+      }
+      try:
+        with open(os.path.expanduser(path), 'a') as f:
+          f.write(json.dumps(record) + '\n')
+      except (OSError, IOError) as e:
+        Logger.error("unable to write metrics: " + str(e))
+
+  @staticmethod
+  def percentile(samples, p):
+    if not samples:
+      return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+  @staticmethod
+  def snapshot():
+    """A list of per tool and feature summaries, slowest p95 first."""
+    with Metrics._lock:
+      items = [(key, dict(stats, latencies=list(stats['latencies']))) for key, stats in Metrics._stats.items()]
+
+    summaries = []
+    for (tool, feature), stats in items:
+      summary = {'tool': tool, 'feature': feature}
+      for name in ['spawns', 'timeouts', 'failures', 'cancelled', 'stdin_bytes', 'stdout_bytes']:
+        summary[name] = stats[name]
+      for p in Metrics.PERCENTILES:
+        summary['p{0}_ms'.format(p)] = round(Metrics.percentile(stats['latencies'], p), 1)
+      summaries.append(summary)
+    summaries.sort(key=lambda s: -s['p95_ms'])
+    return summaries
+
+  @staticmethod
+  def report():
+    header = '{0:<12} {1:<10} {2:>7} {3:>9} {4:>9} {5:>9} {6:>8} {7:>8} {8:>9} {9:>10} {10:>10}'
+    lines = [header.format('tool', 'feature', 'spawns', 'p50 ms', 'p95 ms', 'p99 ms',
+                           'timeouts', 'failures', 'cancelled', 'stdin', 'stdout')]
+    for s in Metrics.snapshot():
+      lines.append(header.format(s['tool'], s['feature'], s['spawns'], s['p50_ms'], s['p95_ms'], s['p99_ms'],
+                                 s['timeouts'], s['failures'], s['cancelled'], s['stdin_bytes'], s['stdout_bytes']))
+    return '\n'.join(lines) + '\n'
+
+  @staticmethod
+  def reset():
+    with Metrics._lock:
+      Metrics._stats.clear()
+
+class Ticket():
+  """A slot granted by the `Scheduler` for one tool process."""
+
+  def __init__(self, priority, key, seq):
+    self.priority = priority
+    self.key = key
+    self.seq = seq
+    self.cancelled = False
+    self.process = None
+
+  def __lt__(self, other):
+    return (self.priority, self.seq) < (other.priority, other.seq)
+
+  def attach(self, process):
+    with Scheduler._cond:
+      self.process = process
+      if self.cancelled:
+        self._kill()
+
+  def _kill(self):
+    if self.process is not None and self.process.poll() is None:
+      try:
+        self.process.kill()
+      except OSError:
+        pass
+
+class Scheduler():
+  """Admission control for every tool process GoTools starts.
+
+  Callers block in `acquire` until a slot is free and no more urgent request
+  is waiting; requests are admitted by feature priority, then in arrival
+  order. At most `max_tool_processes` tools run at once, with one extra slot
+  held back for completion and format since those block the UI thread.
+  Batch work such as a project-wide lint runs at BATCH_PRIORITY on slots of
+  its own, one per core, so it neither waits for nor crowds out the editor's
+  requests.
+
+  A request may carry a coalescing key such as `(view.id(), 'show_type')`.
+  A newer request with the same key cancels the older one: if it is still
+  waiting it gives up its place, if it is running its process is killed.
+  """
+
+  PRIORITIES = {
+    'completion': 0,
+    'format': 0,
+    'goto_def': 1,
+    'oracle': 1,
+    'rename': 1,
+    'show_type': 2,
+    'lint': 3,
+    'prefetch': 4,
+    'lint_project': 5,
+  }
+  BATCH_PRIORITY = 5
+  DEFAULT_PRIORITY = 2
+  DEFAULT_MAX_PROCESSES = 4
+  INTERACTIVE_RESERVE = 1
+
+  _cond = threading.Condition()
+  _waiting = []
+  _running = set()
+  _by_key = {}
+  _seq = 0
+  _max_processes = None
+
+  @staticmethod
+  def acquire(feature=None, key=None):
+    priority = Scheduler.PRIORITIES.get(feature, Scheduler.DEFAULT_PRIORITY)
+    with Scheduler._cond:
+      Scheduler._seq += 1
+      ticket = Ticket(priority, key, Scheduler._seq)
+      if key is not None:
+        Scheduler._cancel_locked(key)
+        Scheduler._by_key[key] = ticket
+      Scheduler._waiting.append(ticket)
+
+      while not ticket.cancelled and not Scheduler._admissible(ticket):
+        Scheduler._cond.wait()
+
+      Scheduler._waiting.remove(ticket)
+      if not ticket.cancelled:
+        Scheduler._running.add(ticket)
+      Scheduler._cond.notify_all()
+      return ticket
+
+  @staticmethod
+  def release(ticket):
+    with Scheduler._cond:
+      Scheduler._running.discard(ticket)
+      if ticket.key is not None and Scheduler._by_key.get(ticket.key) is ticket:
+        del Scheduler._by_key[ticket.key]
+      Scheduler._cond.notify_all()
+
+  @staticmethod
+  def cancel(key):
+    with Scheduler._cond:
+      Scheduler._cancel_locked(key)
+      Scheduler._cond.notify_all()
+
+  @staticmethod
+  def _cancel_locked(key):
+    ticket = Scheduler._by_key.pop(key, None)
+    if ticket is not None:
+      ticket.cancelled = True
+      ticket._kill()
+
+  @staticmethod
+  def _admissible(ticket):
+    # Batch and interactive tickets queue separately, each for its own slots.
+    batch = ticket.priority >= Scheduler.BATCH_PRIORITY
+    head = min(t for t in Scheduler._waiting
+               if not t.cancelled and (t.priority >= Scheduler.BATCH_PRIORITY) == batch)
+    if head is not ticket:
+      return False
+    running = sum(1 for t in Scheduler._running if (t.priority >= Scheduler.BATCH_PRIORITY) == batch)
+    if batch:
+      return running < Scheduler.batch_processes()
+    limit = Scheduler.max_processes()
+    if ticket.priority == 0:
+      limit += Scheduler.INTERACTIVE_RESERVE
+    return running < limit
+
+  @staticmethod
+  def max_processes():
+    if Scheduler._max_processes is None:
+      Scheduler._max_processes = golangconfig.setting_value('max_tool_processes')[0] or Scheduler.DEFAULT_MAX_PROCESSES
+    return Scheduler._max_processes
+
+  @staticmethod
+  def invalidate():
+    """Re-read max_tool_processes on next use; a raised limit may admit waiting tickets."""
+    with Scheduler._cond:
+      Scheduler._max_processes = None
+      Scheduler._cond.notify_all()
+
+  @staticmethod
+  def batch_processes():
+    try:
+      return multiprocessing.cpu_count()
+    except NotImplementedError:
+      return 1
+
+class ToolRegistry():
+  """Resolved tool paths and environments, keyed by project, GOPATH and tool.
+
+  `golangconfig.subprocess_info` reads settings, the shell environment and
+  the filesystem on every call. Results are filled in on first use and
+  shared by every view of a project; changing the golang or GoTools
+  settings or saving a project file clears them.
+  """
+
+  _entries = {}
+  _lock = threading.Lock()
+
+  @staticmethod
+  def resolve(view, tool):
+    window = view.window() if view is not None else None
+    project = window.project_file_name() if window is not None else None
+    gopath = golangconfig.setting_value('gopath', view=view)[0]
+    key = (project, gopath, tool)
+    with ToolRegistry._lock:
+      prepared = ToolRegistry._entries.get(key)
+    if prepared is None:
+      prepared = golangconfig.subprocess_info(tool, ['GOPATH', 'PATH'], view=view)
+      with ToolRegistry._lock:
+        ToolRegistry._entries[key] = prepared
+    return prepared
+
+  @staticmethod
+  def invalidate():
+    with ToolRegistry._lock:
+      ToolRegistry._entries.clear()
+
+class GotoolsToolRegistryListener(sublime_plugin.EventListener):
+  def on_post_save_async(self, view):
+    file_name = view.file_name() or ''
+    if file_name.endswith('.sublime-project'):
+      ToolRegistry.invalidate()
+
+  def on_load_project_async(self, window):
+    ToolRegistry.invalidate()
+
+class SpawnedProcess():
+  """Stands in for a process started by the `Spawner`, so a `Ticket` can kill it."""
+
+  def __init__(self, spawner, ident, done):
+    self.spawner = spawner
+    self.ident = ident
+    self.done = done
+
+  def poll(self):
+    return 0 if self.done.is_set() else None
+
+  def kill(self):
+    self.spawner.send({'id': self.ident, 'kill': True})
+
+class Spawner():
+  """A small helper process that starts tools on the plugin host's behalf.
+
+  With the spawner_python setting, `gotools_spawner.py` runs under that
+  interpreter for the rest of the session, and `ToolRunner` hands it each
+  tool to start rather than forking the large plugin host. Requests from
+  any thread share its pipes and are matched to responses by id. When the
+  helper can't be started or dies, `get` returns None (after MAX_RESTARTS
+  attempts, for the rest of the session) and tools are started directly;
+  a tool the helper was running when it died fails rather than running twice.
+  """
+
+  MAX_RESTARTS = 3
+  SCRIPT = 'gotools_spawner.py'
+
+  _instance = None
+  _restarts = 0
+  _lock = threading.Lock()
+
+  def __init__(self, process):
+    self.process = process
+    self.lock = threading.Lock()
+    self.write_lock = threading.Lock()
+    self.pending = {}
+    self.next_id = 0
+    self.alive = True
+    threading.Thread(target=self.read_responses, daemon=True).start()
+
+  @staticmethod
+  def get():
+    python = golangconfig.setting_value('spawner_python')[0]
+    if not python:
+      return None
+    with Spawner._lock:
+      spawner = Spawner._instance
+      if spawner is not None and spawner.alive:
+        return spawner
+      if Spawner._restarts >= Spawner.MAX_RESTARTS:
+        return None
+      Spawner._restarts += 1
+      Spawner._instance = Spawner.start(python)
+      return Spawner._instance
+
+  @staticmethod
+  def script_path():
+    """The helper script, copied out of the package first if it is zipped."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), Spawner.SCRIPT)
+    if os.path.isfile(path):
+      return path
+    path = os.path.join(sublime.cache_path(), 'GoTools', Spawner.SCRIPT)
+    source = sublime.load_resource('Packages/' + __name__.split('.')[0] + '/' + Spawner.SCRIPT)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+      f.write(source)
+    return path
+
+  @staticmethod
+  def start(python):
+    si = None
+    if platform.system() == "Windows":
+      si = subprocess.STARTUPINFO()
+      si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    try:
+      cmd = [python, Spawner.script_path()]
+      Logger.log("starting tool spawner: " + " ".join(cmd))
+      process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, startupinfo=si)
+    except (OSError, IOError) as e:
+      Logger.error("unable to start tool spawner: " + str(e))
+      return None
+    return Spawner(process)
+
+  @staticmethod
+  def shutdown():
+    with Spawner._lock:
+      spawner = Spawner._instance
+      Spawner._instance = None
+    if spawner is not None:
+      spawner.stop()
+
+  def run(self, cmd, env, stdin, timeout, cwd, ticket):
+    """Run cmd through the helper as (stdout, stderr, returncode, timed_out).
+
+    Returns None if the request couldn't be sent, so the caller can start the
+    tool itself. Once the helper has the request the tool may already be
+    running, so a helper that dies or hangs raises OSError instead.
+    """
+    done = threading.Event()
+    with self.lock:
+      self.next_id += 1
+      ident = self.next_id
+      self.pending[ident] = (done, [])
+    request = {
+      'id': ident,
+      'argv': cmd,
+      'env': env,
+      'cwd': cwd,
+      'stdin': base64.b64encode(stdin).decode('ascii') if stdin is not None else None,
+      'timeout': timeout,
+    }
+    if not self.send(request):
+      with self.lock:
+        self.pending.pop(ident, None)
+      return None
+    ticket.attach(SpawnedProcess(self, ident, done))
+
+    # The helper enforces the timeout; this only guards against a hung helper.
+    if not done.wait(timeout + 5):
+      Logger.error("tool spawner stopped responding")
+      self.stop()
+      with self.lock:
+        self.pending.pop(ident, None)
+      raise OSError("tool spawner stopped responding while running " + cmd[0])
+    with self.lock:
+      response = self.pending.pop(ident)[1]
+    if not response:
+      raise OSError("tool spawner exited while running " + cmd[0])
+    response = response[0]
+    if 'error' in response:
+      raise OSError(response['error'])
+    return (base64.b64decode(response['stdout']), base64.b64decode(response['stderr']),
+            response['rc'], response['timed_out'])
+
+  def send(self, message):
+    with self.write_lock:
+      if not self.alive:
+        return False
+      try:
+        write_message(self.process.stdin, message)
+        return True
+      except (OSError, IOError, ValueError):
+        self.alive = False
+        return False
+
+  def read_responses(self):
+    try:
+      while True:
+        response = read_message(self.process.stdout)
+        if response is None:
+          break
+        with self.lock:
+          waiter = self.pending.get(response['id'])
+        if waiter is not None:
+          waiter[1].append(response)
+          waiter[0].set()
+    except (OSError, IOError, ValueError) as e:
+      Logger.error("tool spawner failed: " + str(e))
+    finally:
+      with self.lock:
+        self.alive = False
+        waiters = list(self.pending.values())
+      for done, response in waiters:
+        done.set()
+
+  def stop(self):
+    with self.lock:
+      self.alive = False
+    try:
+      self.process.stdin.close()
+    except (OSError, IOError):
+      pass
+    try:
+      self.process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+      self.process.kill()
+
+class DiskCache():
+  """Tool output kept on disk across sessions, addressed by what produced it.
+
+  Each entry is one file under the Sublime cache directory, named by a digest
+  of the tool binary (path, size and mtime), its arguments, working
+  directory, Go environment, stdin and a caller-supplied digest of whatever
+  else the output depends on. Entries are written under a temporary name and
+  renamed into place, so readers in other windows or Sublime instances only
+  ever see whole files, and are read through a memory map. Each entry records
+  when the run that produced it started, for callers that check its output
+  against files outside what the key covers. Reading an entry bumps its
+  mtime; once the store outgrows disk_cache_mb the least recently used
+  entries are deleted.
+  """
+
+  MAGIC = b'GTC2'
+  # magic, exit status, start of the run, stdout length, stderr length
+  HEADER = struct.Struct('>4sidQQ')
+  DEFAULT_MB = 256
+  # Writes between checks of the store's size.
+  PRUNE_EVERY = 64
+  ENV_KEYS = ('GOROOT', 'GOPATH', 'GOOS', 'GOARCH', 'GO111MODULE', 'GOFLAGS', 'CGO_ENABLED')
+
+  _writes = 0
+  _pruning = False
+  _lock = threading.Lock()
+
+  @staticmethod
+  def limit():
+    """The store's size bound in bytes; 0 if the cache is disabled."""
+    mb = golangconfig.setting_value('disk_cache_mb')[0]
+    if mb is None:
+      mb = DiskCache.DEFAULT_MB
+    return max(int(mb), 0) * 1024 * 1024
+
+  @staticmethod
+  def root():
+    return os.path.join(sublime.cache_path(), 'GoTools', 'results')
+
+  @staticmethod
+  def key(toolpath, env, args, cwd, stdin, content):
+    """Address of a tool run's output, or None if the tool can't be identified."""
+    try:
+      st = os.stat(toolpath)
+    except OSError:
+      return None
+    env = env or {}
+    identity = [toolpath, st.st_size, st.st_mtime_ns, args, cwd, [env.get(k) for k in DiskCache.ENV_KEYS], content]
+    digest = hashlib.sha1(json.dumps(identity).encode('utf-8'))
+    if stdin is not None:
+      digest.update(hashlib.sha1(stdin).digest())
+    return digest.hexdigest()
+
+  @staticmethod
+  def path(key):
+    return os.path.join(DiskCache.root(), key[:2], key)
+
+  @staticmethod
+  def get(key):
+    """(stdout, stderr, rc, started) stored under key, the output as bytes, or None."""
+    path = DiskCache.path(key)
+    try:
+      with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        magic, rc, started, out_len, err_len = DiskCache.HEADER.unpack_from(m, 0)
+        start = DiskCache.HEADER.size
+        if magic != DiskCache.MAGIC or start + out_len + err_len != len(m):
+          return None
+        stdout = m[start:start + out_len]
+        stderr = m[start + out_len:]
+      os.utime(path, None)
+    except (OSError, ValueError, struct.error):
+      return None
+    return stdout, stderr, rc, started
+
+  @staticmethod
+  def put(key, stdout, stderr, rc, started):
+    path = DiskCache.path(key)
+    tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(tmp, 'wb') as f:
+        f.write(DiskCache.HEADER.pack(DiskCache.MAGIC, rc, started, len(stdout), len(stderr)))
+        f.write(stdout)
+        f.write(stderr)
+      os.replace(tmp, path)
+    except OSError as e:
+      Logger.log("couldn't write tool cache entry {0}: {1}".format(path, e))
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      return
+
+    with DiskCache._lock:
+      DiskCache._writes += 1
+      if DiskCache._writes % DiskCache.PRUNE_EVERY != 1 or DiskCache._pruning:
+        return
+      DiskCache._pruning = True
+    threading.Thread(target=DiskCache.prune, daemon=True).start()
+
+  @staticmethod
+  def prune():
+    """Delete least recently used entries until the store is back to 80% of its limit."""
+    try:
+      limit = DiskCache.limit()
+      now = time.time()
+      entries = []
+      total = 0
+      for path, dirs, files in os.walk(DiskCache.root()):
+        for name in files:
+          file_path = os.path.join(path, name)
+          try:
+            st = os.stat(file_path)
+          except OSError:
+            continue
+          if name.endswith('.tmp'):
+            # Left behind by a writer that died; live ones finish in seconds.
+            if now - st.st_mtime > 3600:
+              DiskCache.remove(file_path)
+            continue
+          entries.append((st.st_mtime, st.st_size, file_path))
+          total += st.st_size
+
+      if total <= limit:
+        return
+      entries.sort()
+      target = limit * 0.8
+      for mtime, size, file_path in entries:
+        if total <= target:
+          break
+        DiskCache.remove(file_path)
+        total -= size
+      Logger.log("pruned tool cache to {0} bytes".format(total))
+    finally:
+      with DiskCache._lock:
+        DiskCache._pruning = False
+
+  @staticmethod
+  def remove(path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
 class ToolRunner():
+  # Exit status reported for a tool whose request was superseded.
+  CANCELLED = -1
+
+  # Seconds between batches of streamed output.
+  STREAM_INTERVAL = 0.1
+
   @staticmethod
   def prepare(view, tool):
-    return golangconfig.subprocess_info(tool, ['GOPATH', 'PATH'], view=view)
+    return ToolRegistry.resolve(view, tool)
 
   @staticmethod
-  def run_prepared(prepared, args=[], stdin=None, timeout=5, cwd=None):
+  def run_prepared(prepared, args=[], stdin=None, timeout=5, cwd=None, feature=None, key=None,
+                   cache_key=None, cache_failures=False):
     toolpath, env = prepared
-    return ToolRunner._run(toolpath, env, args, stdin, timeout, cwd)
+    return ToolRunner._run(toolpath, env, args, stdin, timeout, cwd, feature, key, cache_key, cache_failures)
+
+  @staticmethod
+  def run(view, tool, args=[], stdin=None, timeout=5, cwd=None, feature=None, key=None,
+          cache_key=None, cache_failures=False):
+    """Run a tool and return its (stdout, stderr, exit status).
+
+    Tools whose output is fully determined by their binary, arguments,
+    environment and stdin plus the sources they read can pass a digest of
+    those sources as cache_key, and the result is stored in (and answered
+    from) the DiskCache. Only successful runs are stored unless
+    cache_failures is set.
+    """
+    toolpath, env = ToolRegistry.resolve(view, tool)
+    return ToolRunner._run(toolpath, env, args, stdin, timeout, cwd, feature, key, cache_key, cache_failures)
 
   @staticmethod
-  def run(view, tool, args=[], stdin=None, timeout=5, cwd=None):
-    toolpath, env = golangconfig.subprocess_info(tool, ['GOPATH', 'PATH'], view=view)
-    return ToolRunner._run(toolpath, env, args, stdin, timeout, cwd)
+  def stream(view, tool, args=[], on_output=None, timeout=5, cwd=None, feature=None, key=None,
+             cache_key=None, cache_failures=False, cache_check=None):
+    """Run a tool like `run`, also handing its stdout to on_output as it arrives.
+
+    on_output is called on the calling thread with batches of complete
+    lines, at most every STREAM_INTERVAL seconds while output keeps coming.
+    A cached result is handed over in one batch. With cache_check, a cached
+    result is only used if cache_check(stdout, started) accepts it, started
+    being the time.time() at which the run that produced it began.
+    """
+    toolpath, env = ToolRegistry.resolve(view, tool)
+    return ToolRunner._stream(toolpath, env, args, on_output, timeout, cwd, feature, key, cache_key, cache_failures,
+                              cache_check)
+
+  @staticmethod
+  def _cache_lookup(toolpath, env, args, cwd, stdin, cache_key, cache_check=None):
+    """(address, cached result) of a run in the DiskCache; (None, None) if it isn't cacheable."""
+    if cache_key is None or not DiskCache.limit():
+      return None, None
+    address = DiskCache.key(toolpath, env, args, cwd, stdin, cache_key)
+    if address is None:
+      return None, None
+    cached = DiskCache.get(address)
+    if cached is None:
+      return address, None
+    stdout, stderr, rc, started = cached
+    stdout = stdout.decode("utf-8")
+    if cache_check is not None and not cache_check(stdout, started):
+      Logger.log("stale cached result for: " + " ".join([toolpath] + args))
+      return address, None
+    Logger.log("cached result for: " + " ".join([toolpath] + args))
+    return address, (stdout, stderr.decode("utf-8"), rc)
 
   @staticmethod
-  def _run(toolpath, env, args=[], stdin=None, timeout=5, cwd=None):
+  def _run(toolpath, env, args=[], stdin=None, timeout=5, cwd=None, feature=None, key=None,
+           cache_key=None, cache_failures=False):
     cmd = [toolpath] + args
+    address, cached = ToolRunner._cache_lookup(toolpath, env, args, cwd, stdin, cache_key)
+    if cached is not None:
+      return cached
+
+    ticket = Scheduler.acquire(feature, key)
     try:
+      if ticket.cancelled:
+        Logger.log("skipping superseded command: " + " ".join(cmd))
+        return "", "", ToolRunner.CANCELLED
+
       Logger.log("spawning process...")
       Logger.log("\tcommand:     " + " ".join(cmd))
       Logger.log("\tenvironment: " + str(env))
@@ -114,16 +1229,372 @@ class ToolRunner():
         si = subprocess.STARTUPINFO()
         si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-      start = time.time()
-      p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, startupinfo=si, cwd=cwd)
-      stdout, stderr = p.communicate(input=stdin, timeout=timeout)
-      p.wait(timeout=timeout)
-      elapsed = round(time.time() - start)
-      Logger.log("process returned ({0}) in {1} seconds".format(str(p.returncode), str(elapsed)))
+      started = time.time()
+      start = time.perf_counter()
+      spawner = Spawner.get()
+      result = spawner.run(cmd, env, stdin, timeout, cwd, ticket) if spawner else None
+      if result is not None:
+        stdout, stderr, returncode, timed_out = result
+        if timed_out:
+          Metrics.record(toolpath, feature, (time.perf_counter() - start) * 1000, None, stdin, b'', timed_out=True)
+          raise subprocess.TimeoutExpired(cmd, timeout)
+      else:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, startupinfo=si, cwd=cwd)
+        ticket.attach(p)
+        try:
+          stdout, stderr = p.communicate(input=stdin, timeout=timeout)
+        except subprocess.TimeoutExpired:
+          p.kill()
+          p.communicate()
+          Metrics.record(toolpath, feature, (time.perf_counter() - start) * 1000, None, stdin, b'', timed_out=True)
+          raise
+        p.wait(timeout=timeout)
+        returncode = p.returncode
+      elapsed = (time.perf_counter() - start) * 1000
+      Logger.log("process returned ({0}) in {1:.1f} ms".format(str(returncode), elapsed))
+      Metrics.record(toolpath, feature, elapsed, ToolRunner.CANCELLED if ticket.cancelled else returncode, stdin, stdout)
+      if ticket.cancelled:
+        Logger.log("process was superseded: " + " ".join(cmd))
+        return "", "", ToolRunner.CANCELLED
+      if address and (returncode == 0 or cache_failures and returncode > 0):
+        DiskCache.put(address, stdout, stderr, returncode, started)
       stderr = stderr.decode("utf-8")
       if len(stderr) > 0:
         Logger.log("stderr:\n{0}".format(stderr))
-      x = stdout.decode("utf-8"), stderr, p.returncode
+      x = stdout.decode("utf-8"), stderr, returncode
       return x
     except subprocess.CalledProcessError as e:
       raise
+    finally:
+      Scheduler.release(ticket)
+
+  @staticmethod
+  def _stream(toolpath, env, args, on_output, timeout, cwd, feature, key, cache_key=None, cache_failures=False,
+              cache_check=None):
+    cmd = [toolpath] + args
+    address, cached = ToolRunner._cache_lookup(toolpath, env, args, cwd, None, cache_key, cache_check)
+    if cached is not None:
+      if cached[0] and on_output:
+        on_output(cached[0])
+      return cached
+
+    ticket = Scheduler.acquire(feature, key)
+    try:
+      if ticket.cancelled:
+        Logger.log("skipping superseded command: " + " ".join(cmd))
+        return "", "", ToolRunner.CANCELLED
+
+      Logger.log("spawning streamed process...")
+      Logger.log("\tcommand:     " + " ".join(cmd))
+      Logger.log("\tenvironment: " + str(env))
+
+      # Hide popups on Windows
+      si = None
+      if platform.system() == "Windows":
+        si = subprocess.STARTUPINFO()
+        si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+      started = time.time()
+      start = time.perf_counter()
+      p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, startupinfo=si, cwd=cwd)
+      ticket.attach(p)
+
+      # Both pipes are read on their own threads so that a quiet stdout
+      # doesn't hold back the batch collected so far, and a chatty stderr
+      # can't block the tool.
+      lines = queue.Queue()
+      def read_stdout():
+        for line in iter(p.stdout.readline, b''):
+          lines.put(line)
+        lines.put(None)
+      stderr = []
+      threading.Thread(target=read_stdout, daemon=True).start()
+      drain = threading.Thread(target=lambda: stderr.append(p.stderr.read()), daemon=True)
+      drain.start()
+
+      stdout = []
+      pending = []
+      # The first lines go out straight away.
+      flushed = 0
+      deadline = start + timeout
+      timed_out = False
+      while True:
+        now = time.perf_counter()
+        if now >= deadline:
+          timed_out = True
+          p.kill()
+          break
+        try:
+          line = lines.get(timeout=min(ToolRunner.STREAM_INTERVAL, deadline - now))
+        except queue.Empty:
+          line = b''
+        if line is None:
+          break
+        if line:
+          stdout.append(line)
+          pending.append(line)
+        if pending and on_output and not ticket.cancelled and time.perf_counter() - flushed >= ToolRunner.STREAM_INTERVAL:
+          on_output(b''.join(pending).decode("utf-8"))
+          pending = []
+          flushed = time.perf_counter()
+
+      p.wait()
+      drain.join()
+      stdout = b''.join(stdout)
+      elapsed = (time.perf_counter() - start) * 1000
+      if timed_out:
+        Metrics.record(toolpath, feature, elapsed, None, None, stdout, timed_out=True)
+        raise subprocess.TimeoutExpired(cmd, timeout)
+      Logger.log("process returned ({0}) in {1:.1f} ms".format(str(p.returncode), elapsed))
+      Metrics.record(toolpath, feature, elapsed, ToolRunner.CANCELLED if ticket.cancelled else p.returncode, None, stdout)
+      if ticket.cancelled:
+        Logger.log("process was superseded: " + " ".join(cmd))
+        return "", "", ToolRunner.CANCELLED
+      if pending and on_output:
+        on_output(b''.join(pending).decode("utf-8"))
+      stderr = stderr[0] if stderr else b''
+      if address and (p.returncode == 0 or cache_failures and p.returncode > 0):
+        DiskCache.put(address, stdout, stderr, p.returncode, started)
+      stderr = stderr.decode("utf-8")
+      if len(stderr) > 0:
+        Logger.log("stderr:\n{0}".format(stderr))
+      return stdout.decode("utf-8"), stderr, p.returncode
+    finally:
+      Scheduler.release(ticket)
+
+class GocodeSession():
+  """A gocode daemon kept warm for a single gocode binary and GOPATH.
+
+  gocode clients forward each query over a socket to a long-lived server,
+  autostarting one on the default address when none answers. Sharing that
+  default server between GOPATHs thrashes its package cache, and a server
+  that dies mid-session costs the next keystroke a cold start. Sessions
+  start one server per GOPATH on a free port, check it is still listening
+  before use and restart it when it is not. Servers are started in the
+  background; until one is up, or when it can't be kept alive, queries fall
+  back to a plain `ToolRunner` invocation.
+  """
+
+  HEALTH_CHECK_INTERVAL = 5
+  STARTUP_TIMEOUT = 2
+  MAX_RESTARTS = 3
+
+  _sessions = {}
+  _lock = threading.Lock()
+
+  def __init__(self, prepared):
+    self.prepared = prepared
+    self.addr = None
+    self.process = None
+    self.last_check = 0
+    self.restarts = 0
+    self.starting = False
+    self.checking = False
+    self.closed = False
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def for_view(view):
+    return GocodeSession.for_prepared(ToolRunner.prepare(view, 'gocode'))
+
+  @staticmethod
+  def for_prepared(prepared):
+    toolpath, env = prepared
+    key = (toolpath, env.get('GOPATH', ''))
+    with GocodeSession._lock:
+      session = GocodeSession._sessions.get(key)
+      if session is None:
+        session = GocodeSession(prepared)
+        GocodeSession._sessions[key] = session
+      return session
+
+  @staticmethod
+  def run(view, args=[], stdin=None, timeout=5, feature=None, key=None):
+    if not golangconfig.setting_value('gocode_session', view=view)[0]:
+      return ToolRunner.run(view, 'gocode', args, stdin=stdin, timeout=timeout, feature=feature, key=key)
+    return GocodeSession.for_view(view).query(args, stdin=stdin, timeout=timeout, feature=feature, key=key)
+
+  @staticmethod
+  def shutdown_all():
+    with GocodeSession._lock:
+      sessions = list(GocodeSession._sessions.values())
+      GocodeSession._sessions.clear()
+    for session in sessions:
+      session.shutdown()
+
+  def client_args(self):
+    return ['-sock', 'tcp', '-addr', self.addr]
+
+  def query(self, args=[], stdin=None, timeout=5, feature=None, key=None):
+    if self.ensure_running():
+      with self.lock:
+        client_args = self.client_args()
+      stdout, stderr, rc = ToolRunner.run_prepared(self.prepared, client_args + args, stdin=stdin,
+        timeout=timeout, feature=feature, key=key)
+      if rc in (0, ToolRunner.CANCELLED) or self.is_listening():
+        return stdout, stderr, rc
+      Logger.log("gocode daemon on {0} went away during query".format(self.addr))
+      self.last_check = 0
+    return ToolRunner.run_prepared(self.prepared, args, stdin=stdin, timeout=timeout, feature=feature, key=key)
+
+  def ensure_running(self):
+    """Whether the daemon is ready for queries; if it isn't, (re)start it in the background.
+
+    Called from on_query_completions on the UI thread, so it never waits on
+    the daemon: health checks, stops and starts all happen on other threads.
+    Until a check finds otherwise, a daemon whose process is alive counts as
+    ready.
+    """
+    with self.lock:
+      if self.starting or self.closed:
+        return False
+      alive = self.process is not None and self.process.poll() is None
+      if alive:
+        if not self.checking and time.time() - self.last_check >= GocodeSession.HEALTH_CHECK_INTERVAL:
+          self.checking = True
+          threading.Thread(target=self.check, daemon=True).start()
+        return True
+      if not self.begin_restart():
+        return False
+    threading.Thread(target=self.restart, daemon=True).start()
+    return False
+
+  def begin_restart(self):
+    """Claim a restart, with self.lock held; False once MAX_RESTARTS have been used up."""
+    if self.restarts >= GocodeSession.MAX_RESTARTS:
+      return False
+    self.restarts += 1
+    self.starting = True
+    return True
+
+  def check(self):
+    listening = self.is_listening()
+    with self.lock:
+      self.checking = False
+      if listening:
+        self.last_check = time.time()
+        self.restarts = 0
+        return
+      if self.starting or self.closed:
+        return
+      Logger.log("gocode daemon on {0} stopped listening".format(self.addr))
+      restart = self.begin_restart()
+      if not restart:
+        # Out of restarts; stop it so queries fall back straight away.
+        process, self.process = self.process, None
+    if restart:
+      self.restart()
+    elif process is not None:
+      GocodeSession.terminate(process)
+
+  def restart(self):
+    with self.lock:
+      process, self.process = self.process, None
+    if process is not None:
+      GocodeSession.terminate(process)
+
+    process, addr = self.start()
+    with self.lock:
+      self.starting = False
+      closed = self.closed
+      if not closed:
+        self.process = process
+        self.addr = addr
+        self.last_check = time.time()
+    if process is not None and closed:
+      # Shut down while starting.
+      GocodeSession.terminate(process)
+
+  def is_listening(self, addr=None):
+    addr = addr or self.addr
+    if addr is None:
+      return False
+    host, port = addr.rsplit(':', 1)
+    try:
+      socket.create_connection((host, int(port)), timeout=0.2).close()
+      return True
+    except (OSError, socket.error):
+      return False
+
+  @staticmethod
+  def free_addr():
+    """A local address no server is listening on, picked by the OS."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+      s.bind(('127.0.0.1', 0))
+      return "127.0.0.1:{0}".format(s.getsockname()[1])
+    finally:
+      s.close()
+
+  def start(self):
+    """Start a daemon on a free port; (process, address), or (None, None) if it didn't come up."""
+    toolpath, env = self.prepared
+    try:
+      addr = GocodeSession.free_addr()
+    except (OSError, socket.error) as e:
+      Logger.error("unable to find a port for the gocode daemon: " + str(e))
+      return None, None
+    cmd = [toolpath, '-s', '-sock', 'tcp', '-addr', addr]
+    Logger.log("starting gocode daemon: " + " ".join(cmd))
+
+    si = None
+    if platform.system() == "Windows":
+      si = subprocess.STARTUPINFO()
+      si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    try:
+      process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, env=env, startupinfo=si)
+    except OSError as e:
+      Logger.error("unable to start gocode daemon: " + str(e))
+      return None, None
+
+    deadline = time.time() + GocodeSession.STARTUP_TIMEOUT
+    while time.time() < deadline:
+      if process.poll() is not None:
+        break
+      # Something else may have taken the port since it was picked; only a
+      # listener with our daemon still alive behind it counts.
+      if self.is_listening(addr) and process.poll() is None:
+        return process, addr
+      time.sleep(0.02)
+
+    Logger.error("gocode daemon failed to start on " + addr)
+    GocodeSession.terminate(process)
+    return None, None
+
+  @staticmethod
+  def terminate(process):
+    if process.poll() is None:
+      process.terminate()
+      try:
+        process.wait(timeout=1)
+      except subprocess.TimeoutExpired:
+        process.kill()
+
+  def stop(self):
+    if self.process is None:
+      return
+    GocodeSession.terminate(self.process)
+    self.process = None
+
+  def shutdown(self):
+    with self.lock:
+      self.closed = True
+      self.stop()
+
+SETTINGS_FILES = ['golang.sublime-settings', 'GoTools.sublime-settings']
+
+def settings_changed():
+  ToolRegistry.invalidate()
+  Scheduler.invalidate()
+
+def plugin_loaded():
+  for name in SETTINGS_FILES:
+    sublime.load_settings(name).add_on_change('gotools_tool_registry', settings_changed)
+
+def plugin_unloaded():
+  for name in SETTINGS_FILES:
+    sublime.load_settings(name).clear_on_change('gotools_tool_registry')
+  GocodeSession.shutdown_all()
+  Spawner.shutdown()